@@ -1,61 +1,66 @@
 import numpy as np
 import pandas as pd
-from collections import Counter
-from scipy.spatial.distance import cdist
-from sklearn.preprocessing import RobustScaler
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
+# Stacks of generated models are scored with model_scoring.score_models.
+from model_scoring import preprocess_data, max_distance, vote_codes
 
 
 def load_data(path, sep='\t', names=['l', 'b', 'v', 'near_far']):
     return pd.read_csv(path, sep=sep, header=None, names=names)
 
 
-def preprocess_data(df):
-    df = df.copy()
-    df['near_far_numeric'] = df['near_far'].map({'Near': 0, 'Far': 1})
-    scaler = RobustScaler()
-    normalised = pd.DataFrame(
-        scaler.fit_transform(df[['l', 'b', 'v']]),
-        columns=['l', 'b', 'v']
-    )
-    normalised['near_far'] = df['near_far']
-    normalised['near_far_numeric'] = df['near_far_numeric']
-    return normalised, df
+def whitening_matrix(data):
+    """
+    Cholesky factor L of the inverse covariance of `data` (inv_cov = L L^T).
+    Mahalanobis distances under that covariance are Euclidean distances
+    between points multiplied by L, so points are whitened once and then
+    indexed with an ordinary KD-tree.
+    """
+    inv_cov = np.linalg.inv(np.cov(data.T))
+    return np.linalg.cholesky(inv_cov)
 
 
-def calculate_mahalanobis_distances(data1, data2):
-    cov = np.cov(data1.T)
-    inv_cov = np.linalg.inv(cov)
-    distances = cdist(data1, data2, metric='mahalanobis', VI=inv_cov)
-    return distances, inv_cov
+def vote(labels, indices):
+    """
+    Most common label among the neighbours `indices` (one row per query
+    point, nearest first).
+    """
+    names, codes = np.unique(labels, return_inverse=True)
+    return names[vote_codes(codes[indices], len(names))]
 
 
-def predict_near_far(model_data, catalogue_data, n_neighbors, inv_cov):
-    nn = NearestNeighbors(n_neighbors=n_neighbors, metric='mahalanobis', metric_params={'VI': inv_cov})
-    nn.fit(model_data[['l', 'b', 'v']].values)
-    distances, indices = nn.kneighbors(catalogue_data)
+def model_index(model_data):
+    """KD-tree of the whitened model points, and the whitening matrix."""
+    whiten = whitening_matrix(model_data)
+    return cKDTree(model_data @ whiten), whiten
 
-    predicted_nf = []
-    weights = []
-    for idx, dist in zip(indices, distances):
-        neighbors_nf = model_data['near_far'].iloc[idx].values
-        predicted_nf.append(Counter(neighbors_nf).most_common(1)[0][0])
-        weight = 1 / np.median(dist)
-        weights.append(weight)
 
-    return np.array(predicted_nf), np.array(weights)
+def predict_near_far(model, distances, indices):
+    """
+    Near/far label of each catalogue point by a vote of its nearest model
+    points, weighted by 1 / the median distance to them.
+    """
+    predicted_nf = vote(model['near_far'].values, indices)
+    weights = 1 / np.median(distances, axis=1)
+    return predicted_nf, weights
 
 
 def analyse_model_4d(model, catalogue, model_name, n_neighbors):
     model_data = model[['l', 'b', 'v']].values
     catalogue_data = catalogue[['l', 'b', 'v']].values
 
-    distances, inv_cov = calculate_mahalanobis_distances(model_data, catalogue_data)
-    normalised_distances = distances / np.max(distances)
-    closest_indices = np.argmin(normalised_distances, axis=0)
-    overall_distance_3d = np.mean(np.min(normalised_distances, axis=0))
+    # One index answers both the nearest-point distances and the k-NN vote.
+    tree, whiten = model_index(model_data)
+    k = min(max(n_neighbors, 1), len(model_data))
+    distances, indices = tree.query(catalogue_data @ whiten, k=k)
+    distances = distances.reshape(len(catalogue_data), k)
+    indices = indices.reshape(len(catalogue_data), k)
 
-    predicted_nf, weights = predict_near_far(model, catalogue_data, n_neighbors, inv_cov)
+    max_dist = max_distance(tree.data, catalogue_data @ whiten)
+    closest_indices = indices[:, 0]
+    overall_distance_3d = np.mean(distances[:, 0] / max_dist)
+
+    predicted_nf, weights = predict_near_far(model, distances, indices)
 
     actual_nf = catalogue['near_far'].values
     nf_accuracy = np.sum((predicted_nf == actual_nf) * weights) / np.sum(weights)
@@ -0,0 +1,164 @@
+"""
+Scoring of model point clouds against a catalogue in the 4-D (l, b, v,
+near/far) space, shared with 4d_model_comparison.py (which cannot be
+imported by name). `score_models` scores whole stacks of models, e.g. over
+a grid of orbital parameters, across worker processes, which need its
+helpers from an importable module:
+
+    from model_scoring import model_stack, score_models
+"""
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree, ConvexHull, QhullError
+from scipy.spatial.distance import cdist
+from sklearn.preprocessing import RobustScaler
+
+
+def preprocess_data(df):
+    df = df.copy()
+    df['near_far_numeric'] = df['near_far'].map({'Near': 0, 'Far': 1})
+    scaler = RobustScaler()
+    normalised = pd.DataFrame(
+        scaler.fit_transform(df[['l', 'b', 'v']]),
+        columns=['l', 'b', 'v']
+    )
+    normalised['near_far'] = df['near_far']
+    normalised['near_far_numeric'] = df['near_far_numeric']
+    return normalised, df
+
+
+def hull_vertices(points):
+    """Vertices of the convex hull of `points` (all points if degenerate)."""
+    try:
+        return points[ConvexHull(points).vertices]
+    except (QhullError, ValueError):
+        return points
+
+
+def max_distance(points1, points2):
+    """
+    Largest distance between a point of `points1` and one of `points2`. It
+    is always reached between convex hull vertices, so only those are
+    compared.
+    """
+    return np.max(cdist(hull_vertices(points1), hull_vertices(points2)))
+
+
+def vote_codes(neighbours, n_labels):
+    """
+    Most common of the integer labels 0..n_labels-1 along the last axis of
+    `neighbours` (nearest neighbour first), for any number of leading axes.
+    Ties go to the tied label of the nearest neighbour, as with
+    `Counter.most_common`.
+    """
+    k = neighbours.shape[-1]
+    hits = neighbours[..., None] == np.arange(n_labels)
+    counts = hits.sum(axis=-2)
+    first = np.where(hits.any(axis=-2), hits.argmax(axis=-2), k)
+    first[counts < counts.max(axis=-1, keepdims=True)] = k
+    return np.argmin(first, axis=-1)
+
+
+def robust_scale_stack(points):
+    """
+    `RobustScaler` applied to each model of a (n_models, n_points, 3) stack
+    separately, as `preprocess_data` does for one model.
+    """
+    q25, median, q75 = np.percentile(points, [25, 50, 75], axis=1, keepdims=True)
+    scale = q75 - q25
+    scale[scale == 0] = 1
+    return (points - median) / scale
+
+
+def whitening_stack(points):
+    """`whitening_matrix` of every model of a (n_models, n_points, 3) stack."""
+    centred = points - points.mean(axis=1, keepdims=True)
+    cov = np.einsum('mpi,mpj->mij', centred, centred) / (points.shape[1] - 1)
+    return np.linalg.cholesky(np.linalg.inv(cov))
+
+
+def _query_models(args):
+    """
+    Nearest-neighbour distances and indices of the catalogue points among
+    the points of each whitened model, and each model's normalising
+    maximum distance.
+    """
+    models, catalogues, k = args
+    distances = np.empty(catalogues.shape[:2] + (k,))
+    indices = np.empty(catalogues.shape[:2] + (k,), dtype=int)
+    max_dist = np.empty(len(models))
+    for m, (model, catalogue) in enumerate(zip(models, catalogues)):
+        d, i = cKDTree(model).query(catalogue, k=k)
+        distances[m] = d.reshape(len(catalogue), k)
+        indices[m] = i.reshape(len(catalogue), k)
+        max_dist[m] = max_distance(model, catalogue)
+    return distances, indices, max_dist
+
+
+def score_models(models, catalogue, n_neighbors=None, n_workers=1, chunk_size=64):
+    """
+    Score a stack of model point clouds against one catalogue, as
+    `analyse_model_4d` does for a single model.
+
+    `models` has shape (n_models, n_points, 4): l, b, v and near/far (0 for
+    near, 1 for far) of every model point, e.g. models generated over a
+    grid of orbital parameters. `catalogue` is a catalogue as from
+    `load_data`; it is scaled once for all models. The scaling, covariance
+    and whitening of all models are computed as stacked array operations,
+    and the KD-tree queries run over `n_workers` processes in chunks of
+    `chunk_size` models. `n_neighbors` defaults to sqrt(n_points).
+
+    Returns a dict of arrays of length n_models: 'overall_distance_3d',
+    'nf_accuracy' and 'combined_score'.
+    """
+    models = np.asarray(models, dtype=float)
+    n_models, n_points = models.shape[:2]
+    if n_neighbors is None:
+        n_neighbors = int(round(np.sqrt(n_points)))
+    k = min(max(n_neighbors, 1), n_points)
+
+    normalised, _ = preprocess_data(catalogue)
+    catalogue_data = normalised[['l', 'b', 'v']].values
+    actual_nf = normalised['near_far_numeric'].values
+
+    points = robust_scale_stack(models[:, :, :3])
+    whiten = whitening_stack(points)
+    points = np.einsum('mpi,mij->mpj', points, whiten)
+    catalogues = np.einsum('ci,mij->mcj', catalogue_data, whiten)
+
+    chunks = [(points[i:i+chunk_size], catalogues[i:i+chunk_size], k)
+              for i in range(0, n_models, chunk_size)]
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(chunks))) as executor:
+            results = list(executor.map(_query_models, chunks))
+    else:
+        results = [_query_models(chunk) for chunk in chunks]
+    distances = np.concatenate([r[0] for r in results])
+    indices = np.concatenate([r[1] for r in results])
+    max_dist = np.concatenate([r[2] for r in results])
+
+    overall_distance_3d = np.mean(distances[:, :, 0] / max_dist[:, None], axis=1)
+
+    codes = models[:, :, 3].astype(int)
+    neighbours = np.take_along_axis(codes, indices.reshape(n_models, -1),
+                                    axis=1).reshape(indices.shape)
+    predicted_nf = vote_codes(neighbours, 2)
+    weights = 1 / np.median(distances, axis=2)
+    nf_accuracy = (np.sum((predicted_nf == actual_nf) * weights, axis=1) /
+                   np.sum(weights, axis=1))
+
+    return {'overall_distance_3d': overall_distance_3d,
+            'nf_accuracy': nf_accuracy,
+            'combined_score': (1 - overall_distance_3d + nf_accuracy) / 2}
+
+
+def model_stack(models):
+    """
+    (n_models, n_points, 4) stack of model DataFrames with l, b, v and
+    near_far columns, as from `load_data` in 4d_model_comparison.py (all
+    with the same number of points), near/far encoded as 0/1.
+    """
+    return np.stack([np.column_stack([df[['l', 'b', 'v']].values,
+                                      df['near_far'].map({'Near': 0, 'Far': 1}).values])
+                     for df in models])
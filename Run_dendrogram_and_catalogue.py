@@ -6,57 +6,21 @@ respective indicies.
 ascii & latex format.
 """
 
-import os
 import aplpy
+import warnings
 import numpy as np
 import astrodendro
 from astropy.io import fits
 from astropy import units as u
 import matplotlib.pyplot as plt
 from astropy import constants as const
-from astrodendro import Dendrogram, pp_catalog
-from astrodendro.analysis import PPStatistic
 from astropy import wcs
-from astropy.wcs import WCS
-from astropy.stats import mad_std
 from astropy.table import Table, Column
-import matplotlib.pyplot as plt
-from astrodendro.analysis import PPStatistic, MetadataQuantity
+from leaf_set import leaf_set_config, build_leaf_set, save_leaf_set, leaf_set_key
+from leaf_catalogue import leaf_catalogue, FIELDS
+from pipeline_cache import PipelineCache
 plt.style.use('classic')
 
-class MyPPStatistic(PPStatistic):
-    """
-    It turns out the existing PPStatistic class doesn't work very well with
-    cm^-2 units, so I (credit Adam Ginsburg) made this new class to get the
-    quantities we want.
-    """
-
-    distance = MetadataQuantity('distance', 'Distance to the target', strict=True)
-    particle_mass = MetadataQuantity('particle_mass', 'Mass of each particle', strict=True)
-
-    @property
-    def average_column(self):
-
-        average_col = self.stat.mom0() * self.data_unit / self.stat.count()
-
-        return average_col.to(u.cm**-2)
-
-    @property
-    def mass(self):
-
-        pixel_area = ((self.spatial_scale * self.distance)**2).to(u.cm**2,
-        u.dimensionless_angles())
-        mass = self.stat.mom0() * self.data_unit * pixel_area * self.particle_mass
-
-        return mass.to(u.M_sun)
-
-    @property
-    def median_column(self):
-        return np.nanmedian(self.stat.values) * self.data_unit
-
-    @property
-    def peak_column(self):
-        return np.nanmax(self.stat.values) * self.data_unit
 ###
 
 file = "./../Data/higal_data/column_properunits_conv36_source_only.fits"
@@ -78,50 +42,53 @@ data = fits.getdata(colfile)
 head = fits.getheader(colfile)
 mywcs = wcs.WCS(fits.getheader(colfile))
 
-# Load Brick dendrogram (had to be done separately to isolate the Brick)
-dend_brick = astrodendro.Dendrogram.load_from("./../Dendrogram_files/separate_brick16_dendrogram.fits")
-leaves_brick = dend_brick.leaves[-5]
+# Compute dendrogram for HiGAL column density map, unless the map and the
+# parameters are unchanged since it was last saved.
+dendro_params = {'min_value': 2e22, 'min_delta': 5e22, 'min_npix': 100}
+dendro_files = [leaf_set_config['dendrogram'],
+                './../Dendrogram_files/clouds_only_dendrogram.fits']
 
-# Compute dendrogram for HiGAL column density map
-dend = astrodendro.Dendrogram.compute(data, wcs=mywcs, min_value=2e22, min_delta=5e22, min_npix=100)
-dend.save_to('./../Dendrogram_files/clouds_only_dendrogram.hdf5')
-dend.save_to('./../Dendrogram_files/clouds_only_dendrogram.fits')
-leaves = dend.leaves[9:(len(dend.leaves)-3)]
+def compute_dendrogram():
+    dend = astrodendro.Dendrogram.compute(data, wcs=mywcs, **dendro_params)
+    for filename in dendro_files:
+        dend.save_to(filename)
+
+cache = PipelineCache('./../Cache')
+cache.run('dendrogram', [colfile], dendro_params, dendro_files, compute_dendrogram)
+dend = astrodendro.Dendrogram.load_from(dendro_files[0])
+
+# Build the merged leaf set once: the selected leaves, with the Brick swapped
+# in from its separate dendrogram (see leaf_set.py). It is saved below with
+# its catalogue rows, for the other scripts.
+index = build_leaf_set(leaf_set_config, dend=dend, header=head)
 
 # Get mask for dendrogram leaves ('clouds')
-hdu = fits.open(file)[0]
-mask = np.zeros(hdu.data.shape, dtype=bool)
-for leaf in leaves:
-    if leaf.idx == 45:
-        mask = mask | leaves_brick.get_mask()
-    else:
-        mask = mask | leaf.get_mask()
-mask_hdu = fits.PrimaryHDU(mask.astype('short'), hdu.header)
+mask = index.labels > 0
+mask_hdu = fits.PrimaryHDU(mask.astype('short'), head)
 
+# Build the catalogue of the selected leaves (Brick included) in one pass
 metadata = {}
-metadata['data_unit'] = u.MJy / u.sr
-metadata['spatial_scale'] = (np.abs(head['CDELT2'])) * u.deg
-metadata['WCS'] = mywcs
+metadata['data_unit'] = u.cm**-2
+metadata['spatial_scale'] = mywcs.wcs.cdelt[1] * u.deg
+metadata['beam_major'] = 36 * u.arcsec
+metadata['beam_minor'] = 36 * u.arcsec
+metadata['wcs'] = mywcs
+metadata['distance'] = 8.1*u.kpc
+metadata['particle_mass'] = 2.8*u.Da
+
+temperature_filename = './../Data/higal_data/temp_conv36_source_only.fits'
+temdata = fits.getdata(temperature_filename)
 
-# Force Brick catalogue data into full catalogue
-cat = pp_catalog(leaves, metadata)
-cat_brick = pp_catalog(dend_brick.leaves, metadata)
-cat[cat['_idx']==45] = cat_brick[-5]
-cat[cat['x_cen']==1032.6463805131666][0][0] = 15
+cat_leaves = leaf_catalogue(index, data, metadata, fields=FIELDS,
+                            maps={'tem': (temdata, u.K)})
+cat_leaves.rename_column('x_cen','l_cen')
+cat_leaves.rename_column('y_cen','b_cen')
+save_leaf_set(index, catalogue=cat_leaves, config=leaf_set_config)
 
 # Plot HiGAL column density map with leave contours & labels
-l = np.zeros(len(cat))
-b = np.zeros(len(cat))
-for i in range(0,len(cat),1):
-    l[i] = cat[i][8]
-    b[i] = cat[i][9]
-
 fig=aplpy.FITSFigure(file)
-lab = fig.pixel2world(l,b)
-i = 0
-for structure in leaves:
-    fig.add_label(lab[0][i], lab[1][i], str(i+1), color='yellow',size=5)
-    i = i+1
+for row in cat_leaves:
+    fig.add_label(row['l_cen'], row['b_cen'], str(row['_idx']), color='yellow',size=5)
 fig.recenter(0.45, -0.07, width=400*pc_sc, height=100*pc_sc)
 fig.show_colorscale(cmap='Blues',pmin=0,pmax=99.9)
 fig.add_scalebar(50*pc_sc)
@@ -141,62 +108,6 @@ fig.show_contour(mask_hdu, colors='red', linewidths=0.1)
 fig.save('./../Figs/HiGAL_column_map_with_leaf_contours.eps')
 plt.close()
 
-# Build final catalogue
-metadata = {}
-metadata['data_unit'] = u.cm**-2
-metadata['spatial_scale'] = mywcs.wcs.cdelt[1] * u.deg
-metadata['beam_major'] = 36 * u.arcsec
-metadata['beam_minor'] = 36 * u.arcsec
-metadata['wcs'] = mywcs
-metadata['distance'] = 8.1*u.kpc
-metadata['particle_mass'] = 2.8*u.Da
-
-fields = ['major_sigma', 'minor_sigma', 'radius', 'area_ellipse', 'area_exact',
-          'position_angle', 'x_cen', 'y_cen', 'average_column',
-          'median_column', 'peak_column', 'mass', ]
-
-
-cat = astrodendro.analysis._make_catalog(structures=dend, fields=fields,
-                                         metadata=metadata,
-                                         statistic=MyPPStatistic,
-                                         verbose=False)
-
-cat_brick = astrodendro.analysis._make_catalog(structures=dend_brick.leaves,
-                                               fields=fields,
-                                               metadata=metadata,
-                                               statistic=MyPPStatistic,
-                                               verbose=False)
-
-cat.rename_column('x_cen','l_cen')
-cat.rename_column('y_cen','b_cen')
-
-cat_leaves = cat[[structure.idx for structure in leaves]]
-cat_leaves[cat_leaves['_idx']==45] = cat_brick[-5]
-cat_leaves[cat_leaves['l_cen']==0.2546519427632299][0][0] = 15
-
-temperature_filename = './../Data/higal_data/temp_conv36_source_only.fits'
-temdata = fits.getdata(temperature_filename)
-
-dendro_filename = './../Dendrogram_files/clouds_only_dendrogram.fits'
-dend = astrodendro.Dendrogram.load_from(dendro_filename)
-
-new_columns = {'peak_tem': [], 'mean_tem': [], 'median_tem': []}
-
-# Append dust temperature data
-for struct_id in range(len(leaves)):
-    struct = leaves[struct_id]
-    mask = struct.get_mask()
-
-    new_columns['peak_tem'].append(np.nanmax(temdata[mask]))
-    new_columns['mean_tem'].append(np.nanmean(temdata[mask]))
-    new_columns['median_tem'].append(np.nanmedian(temdata[mask]))
-
-for key in new_columns:
-    cat_leaves.add_column(Column(data=new_columns[key]*u.K, name=key))
-
-for i in range(len(cat_leaves)):
-    cat_leaves['_idx'][i] = i+1
-
 cat_leaves['radius'] = (cat_leaves['radius'].to(u.rad).value)*8100
 cat_leaves['radius'].unit='pc'
 
@@ -239,6 +150,22 @@ name_map = {14: 'Sagittarius B2', 13: 'G1.651-0.050', 17: 'G1.602+0.018',
             35: 'Three Little Pigs',12: '50 km/s cloud', 8: '20 km/s cloud',
             4: 'Sagittarius C'}
 
+# The maps above are keyed by leaf numbers, which only name the same clouds
+# for the leaf set (leaf_set_key: dendrogram and leaf_set_config) the maps
+# were curated for. They are always written to the catalogue, but
+# fit_leaf_spectra.py only takes its v_cen/mean_mom2 columns as fit priors
+# while the current leaf set is the one recorded as curated. After checking
+# the maps against new leaves, run once with maps_curated = True to record it.
+maps_curated = False
+curated_key = leaf_set_key(cache, leaf_set_config)
+if maps_curated:
+    cache.record('curated_maps', curated_key, [])
+curated = cache.is_fresh('curated_maps', curated_key)
+if not curated:
+    warnings.warn("The leaf set is not the one v_map and mom2_map were recorded "
+                  "as curated for (maps_curated); fit_leaf_spectra.py will not "
+                  "use them as priors.")
+
 v_col = []
 for row in cat_leaves_general:
     if row['_idx'] in v_map:
@@ -287,3 +214,8 @@ cat_leaves_general.write('cloud_only_catalog_with_temp.ipac',
                          format='ascii.ipac', overwrite=True)
 cat_leaves_general.write('cloud_only_catalog_with_temp.tex',
                          format='ascii.latex', overwrite=True)
+# Recorded under the current leaf-set key only when curated (see above);
+# fit_leaf_spectra.py uses its priors only while that record is fresh.
+if curated:
+    cache.record('catalogue', curated_key, ['cloud_only_catalog_with_temp.ipac'])
+cache.flush()
@@ -0,0 +1,16 @@
+"""
+Gathers the meanspec FITS files of every survey in extract_leaf_cubes.py into
+one spectrum store per survey (see spectrum_store.py). The extraction stage
+writes the stores itself; this converts spectra extracted before it did, or
+by extract_mean_leaf_spectra.py. Background spectra are only taken from
+files written with the `background` region of extract_leaf_cubes.py.
+"""
+from extract_leaf_cubes import surveys, background
+from leaf_cubes import write_survey_store
+from leaf_set import load_leaf_set
+# _____________________________________
+
+if __name__ == "__main__":
+    index = load_leaf_set()
+    for survey in surveys:
+        write_survey_store(survey, index.numbers, background=background)
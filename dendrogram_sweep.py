@@ -0,0 +1,216 @@
+"""
+Sweeps the dendrogram thresholds (min_value, min_delta, min_npix) over a
+grid, to help choose the values used in Run_dendrogram_and_catalogue.py.
+- The column density map is memory-mapped once per worker process; only the
+pixels a step needs are read and cast to float.
+- Grid points sharing a min_value share one `Dendrogram.compute`: it is run
+with the loosest min_delta / min_npix of the group, and every other point is
+obtained by pruning a copy of it, which is far cheaper than recomputing.
+Pruning does not always merge structures the way `compute` does, so those
+rows (flagged in the `pruned` column) can report a few more or fewer leaves
+and structures than a fresh `compute`.
+- The `n_exact` best points of that pass (most reference leaves matched, then
+best mean overlap; most mass recovered without a reference) are then
+recomputed from scratch with `Dendrogram.compute`, so the shortlist is
+exactly what Run_dendrogram_and_catalogue.py will get with those
+thresholds. n_exact=None recomputes every point.
+- Points (or min_value groups) run in parallel across processes. With fewer
+min_values than workers, the points of each group are split over several
+workers, each computing the group's dendrogram once and pruning it to its
+share of the points, so a short min_value list still uses every worker.
+- Each point is summarised in one table row: number of leaves, leaf mass and
+the fraction of the map's mass it recovers, and how well its leaves overlap
+the reference leaves of the leaf index.
+"""
+import os
+import copy
+import itertools
+import numpy as np
+import astrodendro
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table
+from concurrent.futures import ProcessPoolExecutor
+from leaf_index import LeafIndex, leaf_index_path
+# _____________________________________
+
+colfile = './../Data/higal_data/column_properunits_conv36_source_only.fits'
+reference_file = leaf_index_path('./../Dendrogram_files/clouds_only_dendrogram.hdf5')
+summary_file = './../Dendrogram_files/dendrogram_sweep.ecsv'
+n_workers = os.cpu_count()
+# Number of best points recomputed exactly after the shared pass (see
+# above); None to recompute every point.
+n_exact = 10
+
+min_values = [1e22, 2e22, 3e22, 5e22]
+min_deltas = [1e22, 2e22, 5e22, 1e23, 2e23]
+min_npixs = [25, 50, 100, 200, 400]
+
+distance = 8.1*u.kpc
+particle_mass = 2.8*u.Da
+
+# Per-process state, set by `_init_worker`.
+_sweep = {}
+
+
+def sweep_grid(min_values, min_deltas, min_npixs):
+    """All (min_value, min_delta, min_npix) combinations."""
+    return list(itertools.product(min_values, min_deltas, min_npixs))
+
+
+def _init_worker(colfile, reference_file):
+    data, header = fits.getdata(colfile, header=True, memmap=True)
+    _sweep['data'] = data
+    _sweep['header'] = header
+    finite = np.isfinite(data)
+    _sweep['finite'] = finite
+    _sweep['total'] = data[finite].sum(dtype=float)
+    _sweep['reference'] = (LeafIndex.load(reference_file).labels
+                           if reference_file and os.path.exists(reference_file)
+                           else None)
+
+
+def leaf_labels(dend):
+    """Label map of the dendrogram leaves (0 = none, n = n-th leaf)."""
+    lookup = np.zeros(max([s.idx for s in dend.all_structures] + [0]) + 2,
+                      dtype=np.int32)
+    lookup[np.array([leaf.idx for leaf in dend.leaves], dtype=int) + 1] = \
+        np.arange(1, len(dend.leaves)+1)
+    return lookup[dend.index_map + 1]
+
+
+def overlap(labels, reference, match=0.5):
+    """
+    Best Jaccard index of each reference leaf with any leaf in `labels`.
+    Returns the number of reference leaves matched above `match` and the mean
+    best Jaccard index.
+    """
+    nref = reference.max()
+    if nref == 0:
+        return 0, np.nan
+    ref_area = np.bincount(reference.ravel(), minlength=nref+1)
+    area = np.bincount(labels.ravel())
+    both = (reference > 0) & (labels > 0)
+    pairs, inter = np.unique(np.stack([reference[both], labels[both]]),
+                             axis=1, return_counts=True)
+    jaccard = inter / (ref_area[pairs[0]] + area[pairs[1]] - inter)
+    best = np.zeros(nref+1)
+    np.maximum.at(best, pairs[0], jaccard)
+    best = best[1:][ref_area[1:] > 0]
+    return int((best > match).sum()), float(best.mean())
+
+
+def summarise(dend, params):
+    """One summary row for a dendrogram computed with `params`."""
+    data, header, finite = _sweep['data'], _sweep['header'], _sweep['finite']
+    labels = leaf_labels(dend)
+    npix = np.bincount(labels.ravel())[1:]
+
+    pixel_area = ((np.abs(header['CDELT2'])*u.deg * distance)**2).to(
+        u.cm**2, u.dimensionless_angles())
+    leaf_column = data[(labels > 0) & finite].sum(dtype=float)
+    row = dict(zip(('min_value', 'min_delta', 'min_npix'), params))
+    row['n_leaves'] = len(dend.leaves)
+    row['n_structures'] = len(dend)
+    row['median_npix'] = np.median(npix) if npix.size else 0.
+    row['leaf_mass'] = (leaf_column * u.cm**-2 * pixel_area *
+                        particle_mass).to(u.M_sun).value
+    row['mass_fraction'] = leaf_column / _sweep['total']
+    if _sweep['reference'] is not None:
+        row['ref_matched'], row['ref_jaccard'] = overlap(labels, _sweep['reference'])
+    return row
+
+
+def _sweep_group(task):
+    """
+    Compute the dendrogram of `base` (min_value, min_delta, min_npix) and
+    prune it to each of `points`, which share its min_value.
+    """
+    base_params, points = task
+    base = astrodendro.Dendrogram.compute(
+        _sweep['data'], min_value=base_params[0], min_delta=base_params[1],
+        min_npix=base_params[2])
+    rows = []
+    for params in points:
+        pruned = tuple(params) != tuple(base_params)
+        if pruned:
+            dend = copy.deepcopy(base)
+            dend.prune(min_delta=params[1], min_npix=params[2])
+        else:
+            dend = base
+        rows.append(dict(summarise(dend, params), pruned=pruned))
+    return rows
+
+
+def _sweep_point(params):
+    dend = astrodendro.Dendrogram.compute(_sweep['data'], min_value=params[0],
+                                          min_delta=params[1], min_npix=params[2])
+    return [dict(summarise(dend, params), pruned=False)]
+
+
+def shortlist(rows, n):
+    """
+    Parameters of the `n` best rows: most reference leaves matched, then best
+    mean overlap, or most mass recovered when there is no reference.
+    """
+    def score(row):
+        if 'ref_matched' in row:
+            return (row['ref_matched'], np.nan_to_num(row['ref_jaccard'], nan=-1.))
+        return (row['mass_fraction'],)
+    best = sorted(rows, key=score, reverse=True)[:n]
+    return [tuple(row[k] for k in ('min_value', 'min_delta', 'min_npix'))
+            for row in best]
+
+
+def sweep(grid, colfile, reference_file=None, n_workers=1, n_exact=10):
+    """
+    Summary Table of the dendrogram for every (min_value, min_delta,
+    min_npix) in `grid`, in grid order. All points come from the shared,
+    pruned pass first; the `n_exact` best of them (every point with
+    n_exact=None) are then recomputed with `Dendrogram.compute`. Rows still
+    marked `pruned` may differ slightly from `compute` at those thresholds.
+    """
+    groups = {}
+    for params in grid:
+        groups.setdefault(params[0], []).append(params)
+    # Every part of a group starts from the group's loosest dendrogram,
+    # so the rows do not depend on how the points are split.
+    n_parts = max(1, n_workers // max(len(groups), 1))
+    tasks = []
+    for min_value, points in groups.items():
+        base_params = (min_value, min(p[1] for p in points),
+                       min(p[2] for p in points))
+        tasks += [(base_params, points[k::n_parts])
+                  for k in range(min(n_parts, len(points)))]
+
+    def run(executor):
+        results = list(executor(_sweep_group, tasks)) if n_exact is not None else []
+        rows = dict((tuple(row[k] for k in ('min_value', 'min_delta', 'min_npix')), row)
+                    for group in results for row in group)
+        exact = (list(grid) if n_exact is None else
+                 [p for p in shortlist(rows.values(), n_exact) if rows[p]['pruned']])
+        for group in executor(_sweep_point, exact):
+            for row in group:
+                rows[tuple(row[k] for k in ('min_value', 'min_delta', 'min_npix'))] = row
+        return rows
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, max(len(grid), 1)),
+                                 initializer=_init_worker,
+                                 initargs=(colfile, reference_file)) as executor:
+            rows = run(executor.map)
+    else:
+        _init_worker(colfile, reference_file)
+        rows = run(map)
+
+    rows = [rows[tuple(params)] for params in grid]
+    names = list(rows[0].keys()) if rows else []
+    return Table(rows=[[row[n] for n in names] for row in rows], names=names)
+
+
+if __name__ == "__main__":
+    grid = sweep_grid(min_values, min_deltas, min_npixs)
+    summary = sweep(grid, colfile, reference_file=reference_file,
+                    n_workers=n_workers, n_exact=n_exact)
+    summary.write(summary_file, format='ascii.ecsv', overwrite=True)
+    summary.pprint(max_lines=-1, max_width=-1)
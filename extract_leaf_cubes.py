@@ -0,0 +1,81 @@
+"""
+Extracts sub-cubes for each leaf (cloud) from our dendrogram, for every
+molecular line tracer in every survey listed in `surveys` below.
+Also obtains averaged spectra from the medium around each cloud (the
+'inverted' spectra), which will be used to perform a rough background
+subtraction for the spectra. The background region is set by `background`
+below (see background_regions.py) and its spectra come from the same pass as
+the on-source ones, so the inverted cubes themselves are optional.
+
+The dendrogram leaves and masks are loaded once and shared by all cubes, so
+adding a survey (e.g. ACES or CHIMPS) only needs a new entry in `surveys`.
+"""
+import os
+from astropy.io import fits
+from leaf_cubes import extract_leaf_cubes
+from background_regions import INVERTED
+from leaf_set import load_leaf_set
+from pipeline_cache import PipelineCache
+# _____________________________________
+
+# 'footprint' reprojects only the part of each cube covering a leaf (padded by
+# `footprint_margin` input pixels). 'full' reprojects the whole cube onto the
+# HiGAL grid first and crops each leaf from that. 'weighted' does not reproject
+# the cubes: it averages them on their own grid, weighted by the exact
+# fraction of each pixel covered by the leaf (spectra only, so it needs
+# write_spectra = True and write_cubes = False).
+reproject_mode = 'footprint'
+footprint_margin = 2
+
+# Also write on-source and background mean spectra (to meanspec/ directories),
+# and whether the leaf sub-cubes themselves are still needed.
+write_spectra = True
+write_cubes = True
+
+# Background region of each leaf: 'box' (bounding box minus the leaf, as the
+# old inverted cubes), 'shell' (pixels `gap` to `gap` + `width` HiGAL pixels
+# away from the leaf) or 'annulus' (circular, beyond the leaf's equivalent
+# radius). exclude_leaves leaves the pixels of all other leaves out.
+# INVERTED (the box, not excluding other leaves) gives the same spectra as the
+# old inverted cubes; e.g.
+#   {'kind': 'shell', 'width': 5, 'gap': 1, 'exclude_leaves': True}
+# gives every leaf a background of the same thickness. This is the one
+# background definition of the pipeline: extract_mean_leaf_spectra.py and
+# build_spectrum_stores.py use it too.
+background = INVERTED
+# Also write the inverted (background) sub-cubes. The background spectra are
+# computed directly, so these are off by default and only needed for
+# inspection or for extract_mean_leaf_spectra.py.
+write_background_cubes = False
+
+# Number of worker processes the (molecule, leaf) tasks are spread over.
+n_workers = os.cpu_count()
+
+# Each survey lists its (molecule, cube file) pairs and where the leaf cubes
+# go. Inverted cubes and spectra are written to `out_dir`/Inverted/.
+surveys = [
+    {'name': 'MALT90',
+     'out_dir': './../Leaf_cubes_MALT90/',
+     'lines': [("HNCO", './../Data/MALT90_data/CMZ_3mm_HNCO.fits'),
+               ("HCN", './../Data/MALT90_data/CMZ_3mm_HCN.fits'),
+               ("HC3N", './../Data/MALT90_data/CMZ_3mm_HC3N.fits')]},
+    {'name': 'APEX',
+     'out_dir': './../Leaf_cubes_APEX/',
+     'allow_huge': True,
+     'lines': [("C18O", './APEX_data/APEX_C18O_2014_merge.fits'),
+               ("13CO", './APEX_data/APEX_13CO_2014_merge.fits'),
+               ("H2CO_303_202", './APEX_data/APEX_H2CO_303_202_bl.fits')]},
+]
+
+if __name__ == "__main__":
+    file = "./../Data/higal_data/column_properunits_conv36_source_only.fits"
+    header = fits.getheader(file)
+
+    index = load_leaf_set()
+
+    extract_leaf_cubes(index, surveys, header, reproject_mode=reproject_mode,
+                       footprint_margin=footprint_margin, n_workers=n_workers,
+                       write_cubes=write_cubes, write_spectra=write_spectra,
+                       background=background,
+                       write_background_cubes=write_background_cubes,
+                       cache=PipelineCache('./../Cache'))
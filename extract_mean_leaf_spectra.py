@@ -1,66 +1,67 @@
 """
 Extracts spectra averaged over each leaf for all MALT90 & APEX sub-cubes.
+Sub-cubes whose contents are unchanged since their mean spectrum was last
+written are skipped (see pipeline_cache.py).
+Only needed when extract_leaf_cubes.py runs with write_spectra = False; with
+write_spectra = True the extraction already writes these mean spectra.
+- The leaf cube directories are the output directories of the surveys of
+extract_leaf_cubes.py and their Inverted/ sub-directories; the script does
+not change directory.
+- The inverted cubes are only reduced when extract_leaf_cubes.py writes them
+(write_background_cubes), so leftovers of an earlier background definition
+are never averaged. Their spectra are cached under, and recorded with, the
+`background` region of extract_leaf_cubes.py.
+- With `use_dask` the cubes are read as dask arrays, rechunked to `chunks`
+and reduced with the threaded scheduler on `num_workers` threads, so cubes
+larger than memory are averaged chunk by chunk and those that fit use all
+cores. Otherwise each cube is read and averaged in memory.
 """
 from __future__ import division
 import os
 import glob
-import numpy as np
-from astropy import wcs
-from astropy.io import fits
-from astropy import units as u
-from astropy import constants as const
 from spectral_cube import SpectralCube
-import spectral_cube
+from pipeline_cache import PipelineCache, save_atomic
+from leaf_cubes import record_background
+from extract_leaf_cubes import surveys, background, write_background_cubes
 # _____________________________________
 
-# MALT90
-os.chdir("./../Leaf_cubes_MALT90/")
-if os.path.isdir("./meanspec/") == False:
-    os.mkdir("./meanspec/")
+use_dask = True
+# Dask chunk shape (spectral, y, x), or 'auto'; the spatial mean reduces over
+# whole planes, so chunking along the spectral axis only keeps it cheap.
+chunks = (32, -1, -1)
+num_workers = os.cpu_count()
 
-for filename in glob.glob("*.fits"):
-    t = os.path.splitext(filename)
-    f = str(t[0])
-    cube = SpectralCube.read(filename)
-    meanspec = cube.mean(axis=(1,2))
-    assert meanspec.size == cube.shape[0]
-    meanspec.write("./meanspec/"+f+"_meanspec.fits", overwrite=True)
-
-os.chdir("./../Leaf_cubes_MALT90/Inverted")
-if os.path.isdir("./meanspec/") == False:
-    os.mkdir("./meanspec/")
 
-for filename in glob.glob("*.fits"):
-    t = os.path.splitext(filename)
-    f = str(t[0])
-    cube = SpectralCube.read(filename)
-    meanspec = cube.mean(axis=(1,2))
+def write_meanspec(filename, outfile, use_dask=False, chunks='auto', num_workers=None):
+    if use_dask:
+        cube = SpectralCube.read(filename, use_dask=True).rechunk(chunks)
+        with cube.use_dask_scheduler('threads', num_workers=num_workers):
+            meanspec = cube.mean(axis=(1,2))
+    else:
+        cube = SpectralCube.read(filename)
+        meanspec = cube.mean(axis=(1,2))
     assert meanspec.size == cube.shape[0]
-    meanspec.write("./meanspec/"+f+"_meanspec.fits", overwrite=True)
+    save_atomic(outfile, meanspec.write, overwrite=True)
 
-# APEX
-os.chdir("./../../Leaf_cubes_APEX/")
-if os.path.isdir("./meanspec/") == False:
-    os.mkdir("./meanspec/")
 
-for filename in glob.glob("*.fits"):
-    t = os.path.splitext(filename)
-    f = str(t[0])
-    cube = SpectralCube.read(filename)
-    meanspec = cube.mean(axis=(1,2))
-    assert meanspec.size == cube.shape[0]
-    meanspec.write("./meanspec/"+f+"_meanspec.fits", overwrite=True)
+if __name__ == "__main__":
+    cache = PipelineCache('./../Cache')
 
-os.chdir("./../Leaf_cubes_APEX/Inverted/")
-if os.path.isdir("./meanspec/") == False:
-    os.mkdir("./meanspec/")
+    for survey in surveys:
+        inv_dir = os.path.join(survey['out_dir'], survey.get('inverted_dir', 'Inverted'))
+        for cube_dir, inverted in [(survey['out_dir'], False), (inv_dir, True)]:
+            if (inverted and not write_background_cubes) or not os.path.isdir(cube_dir):
+                continue
+            os.makedirs(os.path.join(cube_dir, "meanspec"), exist_ok=True)
+            params = {'background': background} if inverted else {}
 
-for filename in glob.glob("*.fits"):
-    t = os.path.splitext(filename)
-    f = str(t[0])
-    cube = SpectralCube.read(filename)
-    meanspec = cube.mean(axis=(1,2))
-    assert meanspec.size == cube.shape[0]
-    meanspec.write("./meanspec/"+f+"_meanspec.fits", overwrite=True)
+            for filename in sorted(glob.glob(os.path.join(cube_dir, "*.fits"))):
+                f = os.path.splitext(os.path.basename(filename))[0]
+                outfile = os.path.join(cube_dir, "meanspec", f+"_meanspec.fits")
+                cache.run('meanspec/'+filename, [filename], params, [outfile],
+                          lambda: write_meanspec(filename, outfile, use_dask=use_dask,
+                                                 chunks=chunks, num_workers=num_workers))
+            if inverted:
+                record_background(survey, background)
 
-os.chdir("./../../Scripts")
+    cache.flush()
@@ -0,0 +1,79 @@
+"""
+Fits Gaussians to the mean spectra of every leaf, for every tracer in the
+surveys of extract_leaf_cubes.py, both on-source and background-subtracted.
+The fits run across a pool of worker processes and the results (parameters,
+errors, chi^2, convergence flags) go to a single table. Use fit_HNCO.py to
+plot fits from that table.
+"""
+import os
+import warnings
+from astropy.table import Table
+from extract_leaf_cubes import surveys
+from spectral_fitting import spectrum_jobs, fit_spectra, job_inputs
+from pipeline_cache import PipelineCache, save_atomic
+from leaf_set import leaf_set_key
+# _____________________________________
+
+n_workers = os.cpu_count()
+# 'pyspeckit', or 'numpy' for the vectorised fitter in gaussian_fitter.py
+backend = 'pyspeckit'
+results_file = './../Fits/leaf_spectra_fits.ecsv'
+
+# The number of components and starting values of each fit are derived from
+# the spectrum itself. When the catalogue written by
+# Run_dendrogram_and_catalogue.py was recorded for the current leaf set (only
+# done while the leaf set is the one its hand-kept velocities were recorded
+# as curated for, see `maps_curated` there), its v_cen column breaks ties
+# between detected peaks and its mean_mom2 column gives the width priors.
+catalogue_file = 'cloud_only_catalog_with_temp.ipac'
+
+
+def catalogue_priors(filename, cache=None):
+    """
+    Leaf number -> (list of v_cen, mean_mom2) from the catalogue, skipping
+    entries marked '-'. Empty if the catalogue is missing or, given the
+    PipelineCache `cache`, was not recorded for the current leaf set, whose
+    leaf numbers may then refer to other clouds.
+    """
+    priors = {}
+    if not os.path.exists(filename):
+        return priors
+    if cache is not None and not cache.is_fresh('catalogue', leaf_set_key(cache)):
+        warnings.warn("Catalogue {0} does not match the current dendrogram; "
+                      "fitting without its priors.".format(filename))
+        return priors
+    cat = Table.read(filename, format='ascii.ipac')
+    for row in cat:
+        v_cen = [float(v) for v in str(row['v_cen']).split(',')
+                 if v.strip() not in ('', '-')]
+        mom2 = str(row['mean_mom2']).strip()
+        priors[int(row['_idx'])] = (v_cen or None,
+                                    float(mom2) if mom2 not in ('', '-') else None)
+    return priors
+
+
+if __name__ == "__main__":
+    cache = PipelineCache('./../Cache')
+    priors = catalogue_priors(catalogue_file, cache=cache)
+    jobs = spectrum_jobs(surveys)
+    for job in jobs:
+        job['v_prior'], job['width_prior'] = priors.get(job['leaf'], (None, None))
+
+    def fit_and_write():
+        results = fit_spectra(jobs, n_workers=n_workers, backend=backend)
+        failed = results[results['error'] != '']
+        if len(failed):
+            print("{0} of {1} jobs raised instead of being fitted (see the "
+                  "'error' column), e.g. {2}".format(len(failed), len(results),
+                                                    failed['error'][0]))
+        os.makedirs(os.path.dirname(results_file), exist_ok=True)
+        save_atomic(results_file, results.write, format='ascii.ecsv', overwrite=True)
+
+    # Refit only if a spectrum, a prior or the backend has changed.
+    inputs = sorted(set(path for job in jobs for path in job_inputs(job)
+                        if os.path.exists(path)))
+    params = {'backend': backend,
+              'priors': [(job['leaf'], job['v_prior'], job['width_prior'])
+                         for job in jobs]}
+    cache.run('fits', inputs, params, [results_file], fit_and_write)
+    cache.flush()
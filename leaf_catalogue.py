@@ -0,0 +1,191 @@
+"""
+Catalogue of the selected leaves in one pass over the leaf index.
+- The column density of every leaf is gathered once from the pixel lists of
+the leaf index (Brick already swapped in), so only the selected leaves are
+computed and each of them only once.
+- All fields (moments, average/median/peak column, mass) come out of that
+pass together, followed by the statistics of auxiliary maps such as the
+dust temperature (see leaf_stats.py).
+- By default the fields are computed for all leaves at once by
+`batch_pp_statistics`, with grouped sums over the concatenated pixel arrays,
+so the cost scales with the number of pixels rather than with leaves x
+fields. It reproduces MyPPStatistic, which can still be used per leaf.
+This replaces running pp_catalog / _make_catalog over whole dendrograms and
+then picking and patching rows.
+"""
+import numpy as np
+from astropy import units as u
+from astropy.table import Table, Column
+from astrodendro.analysis import PPStatistic, ScalarStatistic, MetadataQuantity
+from leaf_stats import leaf_map_statistics, grouped_statistics
+
+FIELDS = ['major_sigma', 'minor_sigma', 'radius', 'area_ellipse', 'area_exact',
+          'position_angle', 'x_cen', 'y_cen', 'average_column',
+          'median_column', 'peak_column', 'mass']
+
+
+class MyPPStatistic(PPStatistic):
+    """
+    It turns out the existing PPStatistic class doesn't work very well with
+    cm^-2 units, so I (credit Adam Ginsburg) made this new class to get the
+    quantities we want.
+    """
+
+    distance = MetadataQuantity('distance', 'Distance to the target', strict=True)
+    particle_mass = MetadataQuantity('particle_mass', 'Mass of each particle', strict=True)
+
+    @property
+    def average_column(self):
+
+        average_col = self.stat.mom0() * self.data_unit / self.stat.count()
+
+        return average_col.to(u.cm**-2)
+
+    @property
+    def mass(self):
+
+        pixel_area = ((self.spatial_scale * self.distance)**2).to(u.cm**2,
+        u.dimensionless_angles())
+        mass = self.stat.mom0() * self.data_unit * pixel_area * self.particle_mass
+
+        return mass.to(u.M_sun)
+
+    @property
+    def median_column(self):
+        return np.nanmedian(self.stat.values) * self.data_unit
+
+    @property
+    def peak_column(self):
+        return np.nanmax(self.stat.values) * self.data_unit
+
+
+def batch_pp_statistics(values, indices, offsets, metadata):
+    """
+    MyPPStatistic fields of many structures at once.
+
+    `values` and the (y, x) pixel `indices` of all structures are
+    concatenated, structure i covering offsets[i]:offsets[i+1]. `metadata`
+    is the dict given to MyPPStatistic. Returns a dict of field -> column
+    (Quantity, or plain array for world-coordinate centres), with the same
+    values as evaluating MyPPStatistic on each structure.
+    """
+    y, x = (np.asarray(i, dtype=float) for i in indices)
+    values = np.asarray(values, dtype=float)
+    npix = np.diff(offsets)
+    n = len(npix)
+    group = np.repeat(np.arange(n), npix)
+    # NaN pixels count in the area but not in the sums, as with np.nansum.
+    finite = np.isfinite(values)
+    v = np.where(finite, values, 0.)
+
+    def total(weights):
+        return np.bincount(group, weights=weights, minlength=n)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom0 = total(v)
+        ym, xm = total(v * y) / mom0, total(v * x) / mom0
+        dy, dx = y - ym[group], x - xm[group]
+        w = v / mom0[group]
+        mom2 = np.empty((n, 2, 2))
+        mom2[:, 0, 0] = total(w * dy**2)
+        mom2[:, 1, 1] = total(w * dx**2)
+        mom2[:, 0, 1] = mom2[:, 1, 0] = total(w * dy * dx)
+
+        # Principal axes, ordered as ScalarStatistic.paxes()
+        ok = np.all(np.isfinite(mom2), axis=(1, 2))
+        evals, evecs = np.linalg.eig(np.where(ok[:, None, None], mom2, np.eye(2)))
+        order = np.argsort(evals, axis=1)
+        rows = np.arange(n)
+        major = evecs[rows, :, order[:, 1]]
+        minor = evecs[rows, :, order[:, 0]]
+
+        def along(a):
+            a = a / np.linalg.norm(a, axis=1)[:, None]
+            return np.einsum('si,sij,sj->s', a, mom2, a)
+
+        scale = metadata.get('spatial_scale', u.pixel)
+        data_unit = metadata['data_unit']
+        major_sigma = scale * np.where(ok, np.sqrt(along(major)), np.nan)
+        minor_sigma = scale * np.where(ok, np.sqrt(along(minor)), np.nan)
+
+    columns = {}
+    columns['major_sigma'] = major_sigma
+    columns['minor_sigma'] = minor_sigma
+    columns['radius'] = np.sqrt(major_sigma * minor_sigma)
+    columns['area_ellipse'] = np.pi * major_sigma * minor_sigma * (2.3548 * 0.5)**2
+    columns['area_exact'] = npix * scale**2
+    columns['position_angle'] = np.where(ok, np.degrees(np.arctan2(major[:, 0],
+                                                                   major[:, 1])),
+                                         np.nan) * u.degree
+
+    mywcs = metadata.get('wcs')
+    if mywcs is None:
+        columns['x_cen'], columns['y_cen'] = xm * u.pixel, ym * u.pixel
+    else:
+        world = mywcs.all_pix2world(np.column_stack([xm, ym]), 0)
+        columns['x_cen'], columns['y_cen'] = world[:, 0], world[:, 1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        columns['average_column'] = (mom0 * data_unit / npix).to(u.cm**-2)
+
+    # Peak and median over the finite values of each structure.
+    stats = grouped_statistics(values, offsets, percentiles=())
+    columns['peak_column'] = stats['peak'] * data_unit
+    columns['median_column'] = stats['median'] * data_unit
+
+    if 'distance' in metadata and 'particle_mass' in metadata:
+        pixel_area = ((metadata['spatial_scale'] * metadata['distance'])**2).to(
+            u.cm**2, u.dimensionless_angles())
+        columns['mass'] = (mom0 * data_unit * pixel_area *
+                           metadata['particle_mass']).to(u.M_sun)
+    return columns
+
+
+def leaf_catalogue(index, data, metadata, fields=FIELDS, statistic=None,
+                   maps=None, map_stats=('peak', 'mean', 'median')):
+    """
+    Catalogue of the leaves of `index`, one row per leaf in leaf-number order
+    with `_idx` holding the leaf number.
+
+    `fields` are evaluated on the values of `data` (the map the dendrogram
+    was computed on) over each leaf, for all leaves at once with
+    `batch_pp_statistics`, or leaf by leaf as properties of `statistic` (a
+    PPStatistic subclass such as MyPPStatistic) if one is given. `maps` is a dict
+    of name -> map or name -> (map, unit) of other maps on the same grid;
+    the `map_stats` of each are added as `<stat>_<name>` columns.
+    """
+    values = data.ravel()[index.pixels]
+    y, x = np.unravel_index(index.pixels, index.shape)
+
+    if statistic is None:
+        columns = batch_pp_statistics(values, (y, x), index.offsets, metadata)
+        missing = [field for field in fields if field not in columns]
+        if missing:
+            raise ValueError("Fields not available in batch_pp_statistics: "
+                             + ', '.join(missing))
+        # Leaf n covers offsets[n-1]:offsets[n]
+        columns = [columns[field][index.numbers - 1] for field in fields]
+    else:
+        rows = []
+        for number in index.numbers:
+            leaf = slice(index.offsets[number-1], index.offsets[number])
+            stat = statistic(ScalarStatistic(values[leaf], (y[leaf], x[leaf])),
+                             metadata)
+            rows.append([getattr(stat, field) for field in fields])
+        columns = [[row[i] for row in rows] for i in range(len(fields))]
+
+    cat = Table()
+    cat.add_column(Column(data=index.numbers, name='_idx'))
+    for field, column in zip(fields, columns):
+        if isinstance(column, u.Quantity) or isinstance(column[0], u.Quantity):
+            column = u.Quantity(column)
+            cat.add_column(Column(data=column.value, name=field, unit=column.unit))
+        else:
+            cat.add_column(Column(data=column, name=field))
+
+    for name, value in (maps or {}).items():
+        map_data, unit = value if isinstance(value, tuple) else (value, None)
+        stats = leaf_map_statistics(index, map_data, name, unit=unit)
+        for stat_name in map_stats:
+            cat.add_column(stats[stat_name+'_'+name])
+    return cat
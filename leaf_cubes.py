@@ -0,0 +1,461 @@
+"""
+Helpers shared by the leaf sub-cube extraction scripts.
+- Reprojects only the part of a survey cube that covers a leaf's bounding box
+('view', from the leaf index) on the HiGAL column density grid (plus a
+small margin), rather than reprojecting the whole cube onto the full HiGAL
+grid and cropping afterwards. Peak memory then scales with the leaf size
+instead of the survey size.
+- Alternatively ('weighted' mode) skips reprojecting the cubes altogether and
+averages them on their native grid, weighted by the exact fractional coverage
+of each pixel by the leaf, which only needs 2-D reprojections.
+- Runs every (survey, molecule) extraction job from a declarative survey
+config against a leaf set that is loaded only once, optionally spread over a
+pool of worker processes.
+"""
+import os
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from astropy import wcs
+from spectral_cube import SpectralCube
+from leaf_spectra import leaf_mean_spectra, weighted_mean_spectra, mean_spectrum
+from mask_regrid import covering_view, leaf_coverage
+from background_regions import (INVERTED, background_regions, enclosing_view,
+                                place_mask)
+from pipeline_cache import save_atomic, write_json
+from spectrum_store import (cube_velocity, read_spectrum, spectrum_store_path,
+                            write_spectrum_store)
+
+
+def footprint_header(cube_header, target_wcs, view):
+    """
+    Copy of `cube_header` with its celestial axes replaced by the part of
+    `target_wcs` covered by `view`. The spectral axis is left untouched.
+    """
+    header = cube_header.copy()
+    header.update(target_wcs.celestial[view].to_header())
+    header['NAXIS1'] = view[1].stop - view[1].start
+    header['NAXIS2'] = view[0].stop - view[0].start
+    return header
+
+
+def input_view(cube, target_wcs, view, margin=2, nsamp=5):
+    """
+    Pixel region of `cube` that covers `view` on the target grid, padded by
+    `margin` input pixels so that the interpolation kernel is fully sampled
+    at the edges of the footprint.
+    """
+    return covering_view(target_wcs, view, cube.wcs, cube.shape[1:],
+                         margin=margin, nsamp=nsamp)
+
+
+def reproject_footprint(cube, target_wcs, view, margin=2):
+    """
+    Reproject the part of `cube` covering `view` onto that view of the target
+    grid. The result matches ``cube.reproject(full_header)[:, view]`` but only
+    ever holds the leaf-sized region in memory.
+    """
+    yv, xv = input_view(cube, target_wcs, view, margin=margin)
+    subcube = cube[:, yv, xv]
+    return subcube.reproject(footprint_header(subcube.header, target_wcs, view))
+
+
+def extract_leaf(leaf_cube, submask, bg_mask=None):
+    """
+    Masked sub-cube of a leaf, plus its inverted counterpart used for the
+    background spectra: the `bg_mask` region (see background_regions.py),
+    by default everything in the bounding box except the leaf.
+    """
+    if bg_mask is None:
+        bg_mask = ~submask
+    cropcube = leaf_cube.with_mask(submask[None,:,:])
+    cropcube_inv = leaf_cube.with_mask(bg_mask[None,:,:])
+    return cropcube, cropcube_inv
+
+
+def task_regions(leaf_set, backgrounds):
+    """
+    Per leaf, the view covering both the leaf and its background region,
+    with the leaf and background masks over that view and the leaf's own
+    bounding box within it. Returns a dict of number -> (view, submask,
+    bg_mask, crop).
+    """
+    regions = {}
+    for number, view, submask in leaf_set:
+        bview, bg_mask = backgrounds[number]
+        outer = enclosing_view(view, bview)
+        crop = (slice(view[0].start - outer[0].start, view[0].stop - outer[0].start),
+                slice(view[1].start - outer[1].start, view[1].stop - outer[1].start))
+        regions[number] = (outer, place_mask(submask, view, outer),
+                           place_mask(bg_mask, bview, outer), crop)
+    return regions
+
+
+def extraction_jobs(surveys):
+    """
+    Flatten the survey config into (survey, molecule, cube_file) jobs.
+    """
+    return [(survey, mol, cube_file)
+            for survey in surveys
+            for mol, cube_file in survey['lines']]
+
+
+def leaf_cube_paths(survey, number, mol):
+    """
+    Output paths of the masked and inverted sub-cube of one leaf.
+    """
+    name = survey.get('cube_name', '{leaf}_{mol}_cube.fits').format(leaf=number,
+                                                                 mol=mol)
+    inv_dir = os.path.join(survey['out_dir'], survey.get('inverted_dir', 'Inverted'))
+    return os.path.join(survey['out_dir'], name), os.path.join(inv_dir, name)
+
+
+def leaf_spectrum_paths(survey, number, mol):
+    """
+    Output paths of the mean spectra of the masked and inverted sub-cube of
+    one leaf, named as by extract_mean_leaf_spectra.py.
+    """
+    return tuple(os.path.join(os.path.dirname(path), 'meanspec',
+                              os.path.splitext(os.path.basename(path))[0]+'_meanspec.fits')
+                 for path in leaf_cube_paths(survey, number, mol))
+
+
+def background_record_path(survey):
+    """
+    File recording the background region the survey's inverted mean spectra
+    were taken from.
+    """
+    return os.path.join(survey['out_dir'], survey.get('inverted_dir', 'Inverted'),
+                        'meanspec', 'background.json')
+
+
+def record_background(survey, background):
+    """Record `background` as the region of the survey's inverted spectra."""
+    write_json(background_record_path(survey), background)
+
+
+def recorded_background(survey):
+    """
+    Background region of the survey's inverted mean spectra; INVERTED for
+    spectra written before it was recorded, which all came from the inverted
+    sub-cubes.
+    """
+    path = background_record_path(survey)
+    if not os.path.exists(path):
+        return INVERTED
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_leaf_spectra(survey, number, mol):
+    """
+    Velocity axis (km/s) and on-source and background values of the mean
+    spectra of one leaf, read from its meanspec files (background None if
+    missing).
+    """
+    spec_path, inv_spec_path = leaf_spectrum_paths(survey, number, mol)
+    velocity, on = read_spectrum(spec_path)
+    bg = read_spectrum(inv_spec_path)[1] if os.path.exists(inv_spec_path) else None
+    return velocity, on, bg
+
+
+def write_survey_store(survey, numbers, spectra=None, background=INVERTED):
+    """
+    Write the spectrum store of a survey (see spectrum_store.py) for the
+    leaves `numbers`. Spectra are taken from `spectra`, (number, mol) ->
+    (velocity, on, bg), where given and read from the meanspec files
+    otherwise; leaves without either are left out. Background spectra read
+    from files are only used if they were taken from the region
+    `background`, so one store never mixes background definitions.
+    """
+    spectra = dict(spectra or {})
+    same_background = recorded_background(survey) == background
+    for mol, cube_file in survey['lines']:
+        for number in numbers:
+            if ((number, mol) not in spectra and
+                    os.path.exists(leaf_spectrum_paths(survey, number, mol)[0])):
+                velocity, on, bg = read_leaf_spectra(survey, number, mol)
+                spectra[(number, mol)] = (velocity, on, bg if same_background else None)
+    if spectra:
+        write_spectrum_store(spectrum_store_path(survey), spectra,
+                             molecules=[mol for mol, cube_file in survey['lines']],
+                             velocity=survey.get('velocity'),
+                             unit=survey.get('unit', 'K'))
+
+
+# Cubes opened by this process, keyed by file name. Workers keep the last cube
+# they read so consecutive tasks on the same molecule share one memory-mapped
+# read of the file rather than a copy each.
+_open_cubes = {}
+
+
+def _read_cube(cube_file):
+    if cube_file not in _open_cubes:
+        _open_cubes.clear()
+        _open_cubes[cube_file] = SpectralCube.read(cube_file)
+    return _open_cubes[cube_file]
+
+
+def _extract_task(task):
+    """
+    Extract the masked and inverted sub-cubes of one leaf for one molecule,
+    and write them and/or their mean spectra. `cube_file` is either the
+    survey cube ('footprint' mode) or the cube already reprojected onto the
+    target grid ('full' mode). `view` covers the leaf and its background
+    region; the leaf sub-cube is cropped to the leaf's own box (`crop`).
+    Returns the task's key and the values of its two mean spectra, if any.
+    """
+    cube = _read_cube(task['cube_file'])
+    view = task['view']
+    if task['mode'] == 'footprint':
+        leaf_cube = reproject_footprint(cube, task['target_wcs'], view,
+                                        margin=task['margin'])
+    else:
+        leaf_cube = cube[(slice(None),) + view]
+
+    cropcube, cropcube_inv = extract_leaf(leaf_cube, task['submask'], task['bg_mask'])
+    if task['cube_paths'] is not None:
+        save_atomic(task['cube_paths'][0], cropcube[(slice(None),) + task['crop']].write,
+                    overwrite=True)
+        if task['cube_paths'][1] is not None:
+            save_atomic(task['cube_paths'][1], cropcube_inv.write, overwrite=True)
+    if task['spectrum_paths'] is not None:
+        on, bg = cropcube.mean(axis=(1,2)), cropcube_inv.mean(axis=(1,2))
+        save_atomic(task['spectrum_paths'][0], on.write, overwrite=True)
+        save_atomic(task['spectrum_paths'][1], bg.write, overwrite=True)
+        return task['key'], on.value, bg.value
+
+
+def _write_leaf_spectra(cube_file, labels, leaf_set, backgrounds, survey, mol,
+                        chunk_size):
+    """
+    Mean spectra of every leaf and of its background region (None for the
+    rest of the bounding box) from one streaming pass over a cube that is
+    already on the target grid. Returns number -> (on, bg) values.
+    """
+    cube = _read_cube(cube_file)
+    views = dict((number, view) for number, view, submask in leaf_set)
+    numbers, on, bg = leaf_mean_spectra(cube, labels, views, backgrounds=backgrounds,
+                                        chunk_size=chunk_size)
+    for number, on_spec, bg_spec in zip(numbers, on, bg):
+        spec_path, inv_spec_path = leaf_spectrum_paths(survey, number, mol)
+        save_atomic(spec_path, mean_spectrum(cube, on_spec).write, overwrite=True)
+        save_atomic(inv_spec_path, mean_spectrum(cube, bg_spec).write, overwrite=True)
+    return dict((number, (on_spec, bg_spec)) for number, on_spec, bg_spec
+                in zip(numbers, on, bg))
+
+
+def _write_weighted_spectra(cube_file, index, background, survey, mol, chunk_size,
+                            coverage_dir=None):
+    """
+    Mean spectra of every leaf on the cube's own grid, weighted by the
+    fraction of each cube pixel covered by the leaf (on-source) and by its
+    background region (see background_regions.py). Leaves or backgrounds
+    outside the cube get all-NaN spectra. Returns number -> (on, bg) values.
+    """
+    cube = SpectralCube.read(cube_file)
+    grid_wcs, shape = cube.wcs.celestial, cube.shape[1:]
+    leaf = leaf_coverage(index, grid_wcs, shape, cache_dir=coverage_dir)
+    bg = leaf_coverage(index, grid_wcs, shape, region='background',
+                       background=background, cache_dir=coverage_dir)
+    spectra = weighted_mean_spectra(cube, [(view, fraction) for number, view, fraction
+                                           in leaf + bg], chunk_size=chunk_size)
+    on = dict(zip([n for n, v, f in leaf], spectra[:len(leaf)]))
+    bg = dict(zip([n for n, v, f in bg], spectra[len(leaf):]))
+
+    missing = np.full(cube.shape[0], np.nan)
+    values = {}
+    for number, view, submask in index.leaf_set():
+        values[number] = (on.get(number, missing), bg.get(number, missing))
+        spec_path, inv_spec_path = leaf_spectrum_paths(survey, number, mol)
+        save_atomic(spec_path, mean_spectrum(cube, values[number][0]).write, overwrite=True)
+        save_atomic(inv_spec_path, mean_spectrum(cube, values[number][1]).write, overwrite=True)
+    return values
+
+
+def extract_leaf_cubes(index, surveys, target_header, reproject_mode='footprint',
+                       footprint_margin=2, n_workers=1, write_cubes=True,
+                       write_spectra=False, chunk_size=32, background=INVERTED,
+                       write_background_cubes=False, write_store=True, cache=None):
+    """
+    Run every (survey, molecule) job against the leaves of a shared
+    `LeafIndex`, writing a masked sub-cube per leaf (and its inverted,
+    background sub-cube with ``write_background_cubes=True``).
+
+    With `n_workers` > 1 the (molecule, leaf) tasks are spread over a process
+    pool. Workers memory-map the cube they need rather than receiving a copy:
+    in 'full' mode each reprojected cube is first written to a scratch FITS
+    file in the survey's output directory, which is removed afterwards, when
+    sub-cubes are written. With a single worker the tasks of each job run as
+    soon as it is prepared, on the reprojected cube held in memory, as do
+    the spectra.
+
+    With `write_spectra` the on-source and inverted (background) mean spectra
+    are also written to meanspec/ directories, in the format of
+    extract_mean_leaf_spectra.py, and the sub-cubes can be skipped altogether
+    with ``write_cubes=False``. In 'full' mode the spectra of all leaves come
+    from a single pass over the reprojected cube, `chunk_size` channels at a
+    time (see `leaf_spectra.leaf_mean_spectra`).
+
+    `background` sets the region the background spectra are taken from, as
+    keyword arguments of `background_regions.background_regions`: by
+    default the rest of the leaf's bounding box, or a shell or annulus of
+    fixed width around the leaf, optionally excluding all other leaves. The
+    background spectra come from the same pass as the on-source ones, so
+    the background sub-cubes are only written on request
+    (``write_background_cubes=True``), e.g. for inspection.
+
+    reproject_mode='weighted' does not reproject the cubes at all and only
+    writes spectra (it needs write_spectra=True and write_cubes=False): each
+    leaf's exact fractional coverage of the survey pixels is computed on the
+    2-D grid, and the spectra are coverage-weighted means over the native
+    cube (see `_write_weighted_spectra`).
+
+    With `write_spectra` and `write_store` the spectra of each survey are
+    also gathered into its spectrum store (see spectrum_store.py), from the
+    values computed in this run; spectra of jobs skipped by the cache are
+    read back from their meanspec files.
+
+    With a `pipeline_cache.PipelineCache`, a (survey, molecule) job is
+    skipped when its cube, the leaf index and the extraction parameters are
+    unchanged since its outputs were last written.
+    """
+    if reproject_mode == 'weighted' and (write_cubes or not write_spectra):
+        raise ValueError("reproject_mode='weighted' only writes mean spectra: "
+                         "use write_spectra=True and write_cubes=False")
+    target_wcs = wcs.WCS(target_header).celestial
+    leaf_set = index.leaf_set()
+    backgrounds = dict((number, (view, mask)) for number, view, mask
+                       in background_regions(index, **background))
+    regions = task_regions(leaf_set, backgrounds)
+    coverage_dir = (os.path.join(cache.root, 'coverage')
+                    if cache is not None else None)
+    params = {'index': index.digest(), 'target': target_wcs.to_header_string(),
+              'reproject_mode': reproject_mode, 'margin': footprint_margin,
+              'write_cubes': write_cubes, 'write_spectra': write_spectra,
+              'background': background, 'write_background_cubes': write_background_cubes}
+
+    tasks = []
+    results = []
+    scratch_files = []
+    done = []
+    # survey name -> {(number, mol): (velocity, on, bg)} of the jobs run here
+    spectra = {}
+    velocities = {}
+    try:
+        for survey, mol, cube_file in extraction_jobs(surveys):
+            outputs = []
+            for number, view, submask in leaf_set:
+                if write_cubes:
+                    outputs += leaf_cube_paths(survey, number, mol)[:1 + write_background_cubes]
+                if write_spectra:
+                    outputs += leaf_spectrum_paths(survey, number, mol)
+            if cache is not None:
+                artifact = 'extract/'+survey['name']+'/'+str(mol)
+                key = cache.key([cube_file], dict(params, out_dir=survey['out_dir']))
+                if cache.is_fresh(artifact, key):
+                    continue
+                done.append((artifact, key, outputs))
+            spectra.setdefault(survey['name'], {})
+            if write_spectra:
+                velocities[(survey['name'], mol)] = cube_velocity(cube_file)
+
+            inv_dir = os.path.join(survey['out_dir'],
+                                   survey.get('inverted_dir', 'Inverted'))
+            os.makedirs(inv_dir, exist_ok=True)
+            if write_spectra:
+                os.makedirs(os.path.join(survey['out_dir'], 'meanspec'), exist_ok=True)
+                os.makedirs(os.path.join(inv_dir, 'meanspec'), exist_ok=True)
+
+            if reproject_mode == 'weighted':
+                values = _write_weighted_spectra(cube_file, index, background, survey, mol,
+                                                 chunk_size, coverage_dir=coverage_dir)
+                spectra[survey['name']].update(
+                    ((number, mol), (velocities[(survey['name'], mol)],) + values[number])
+                    for number in values)
+                continue
+
+            if reproject_mode == 'full':
+                cube = SpectralCube.read(cube_file)
+                cube_header = cube.header.copy()
+                cube_header.update(target_wcs.to_header())
+                cube_header['NAXIS1'] = target_header['NAXIS1']
+                cube_header['NAXIS2'] = target_header['NAXIS2']
+                cube.allow_huge_operations = survey.get('allow_huge', False)
+                # The spectra, and sub-cube tasks run in this process, use
+                # the reprojected cube in memory.
+                cube_file = '<reprojected '+survey['name']+' '+str(mol)+'>'
+                _open_cubes.clear()
+                _open_cubes[cube_file] = cube.reproject(cube_header)
+                if write_spectra:
+                    values = _write_leaf_spectra(cube_file, index.labels, leaf_set,
+                                                 None if background == INVERTED else backgrounds,
+                                                 survey, mol, chunk_size)
+                    spectra[survey['name']].update(
+                        ((number, mol), (velocities[(survey['name'], mol)],) + values[number])
+                        for number in values)
+                if not write_cubes:
+                    continue
+                if n_workers > 1:
+                    # Workers read the reprojected cube back from disk.
+                    scratch_file = os.path.join(survey['out_dir'],
+                                                '.reprojected_'+str(mol)+'.fits')
+                    save_atomic(scratch_file, _open_cubes[cube_file].write, overwrite=True)
+                    scratch_files.append(scratch_file)
+                    _open_cubes.clear()
+                    cube_file = scratch_file
+
+            job_tasks = []
+            for number, view, submask in leaf_set:
+                view, submask, bg_mask, crop = regions[number]
+                cube_paths = leaf_cube_paths(survey, number, mol)
+                if not write_background_cubes:
+                    cube_paths = (cube_paths[0], None)
+                job_tasks.append({
+                    'cube_file': cube_file, 'target_wcs': target_wcs,
+                    'view': view, 'submask': submask, 'bg_mask': bg_mask,
+                    'crop': crop, 'mode': reproject_mode,
+                    'key': (survey['name'], number, mol),
+                    'margin': footprint_margin,
+                    'cube_paths': cube_paths if write_cubes else None,
+                    'spectrum_paths': (leaf_spectrum_paths(survey, number, mol)
+                                       if write_spectra and reproject_mode != 'full'
+                                       else None)})
+            if n_workers > 1:
+                tasks += job_tasks
+            else:
+                # Run now, while this job's cube is the one held open.
+                results += [_extract_task(task) for task in job_tasks]
+
+        if n_workers > 1:
+            n_leaves = max(len(leaf_set), 1)
+            chunksize = max(1, min(n_leaves, len(tasks) // (4 * n_workers)))
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(_extract_task, tasks, chunksize=chunksize))
+        for result in results:
+            if result is not None:
+                (name, number, mol), on, bg = result
+                spectra[name][(number, mol)] = (velocities[(name, mol)], on, bg)
+
+        if write_spectra:
+            for survey in surveys:
+                if survey['name'] in spectra:
+                    record_background(survey, background)
+        if write_spectra and write_store:
+            for survey in surveys:
+                # Nothing new for a survey whose jobs were all fresh.
+                if (survey['name'] in spectra or
+                        not os.path.exists(spectrum_store_path(survey))):
+                    write_survey_store(survey, [n for n, v, m in leaf_set],
+                                       spectra.get(survey['name']),
+                                       background=background)
+
+        for artifact, key, outputs in done:
+            cache.record(artifact, key, outputs)
+        if cache is not None:
+            cache.flush()
+    finally:
+        _open_cubes.clear()
+        for scratch_file in scratch_files:
+            if os.path.exists(scratch_file):
+                os.remove(scratch_file)
@@ -0,0 +1,141 @@
+"""
+Helpers for cutting the HiGAL maps around every leaf in one pass.
+- Each map is opened once, memory-mapped, with its WCS built once.
+- Cutouts are zero-copy `Cutout2D` views of the memory-mapped maps, so only
+the pixels around the leaves are ever read from disk.
+- Any number of maps on the HiGAL grid (column density, dust temperature,
+...) are cut at the same pixel position and size; maps on other grids get
+their own cutout at the same sky position and angular size.
+- Cutouts are written as one FITS file per leaf and layer, as a single
+multi-extension FITS file, or as a single HDF5 archive.
+"""
+import os
+import numpy as np
+from astropy import units as u
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+from astropy.nddata import Cutout2D
+
+
+def open_maps(maps):
+    """
+    Open every map of `maps` (dict of name -> FITS file) memory-mapped.
+    Returns a dict of name -> (data, header, wcs), in the order of `maps`.
+    """
+    layers = {}
+    for name, filename in maps.items():
+        hdu = fits.open(filename, memmap=True)[0]
+        header = hdu.header
+        layers[name] = (hdu.data, header, WCS(header).celestial)
+    return layers
+
+
+def cutout_size(area, pix_width, factor=4):
+    """
+    Cutout side in pixels: `factor` times the equivalent radius
+    sqrt(area / pi) of a leaf, with `area` and `pix_width` in degrees.
+    """
+    return factor * int(np.around(np.sqrt(area / np.pi) / pix_width))
+
+
+def _same_grid(layer, reference):
+    data, header, mywcs = layer
+    return (data.shape == reference[0].shape and
+            mywcs.wcs.compare(reference[2].wcs))
+
+
+def leaf_cutouts(cat, layers, size_factor=4):
+    """
+    Cutouts of every layer around every leaf of the catalogue `cat` (with
+    `_idx`, `l_cen`, `b_cen` in degrees and `area_exact` in deg^2).
+
+    The first layer sets the grid: the cutout size is computed from its pixel
+    width, and layers on the same grid are cut at the same pixel position.
+    Yields (leaf number, dict of name -> Cutout2D).
+    """
+    names = list(layers)
+    reference = layers[names[0]]
+    pix_width = np.abs(reference[2].wcs.cdelt[1])
+    same = dict((name, _same_grid(layers[name], reference)) for name in names)
+
+    for row in cat:
+        size = cutout_size(float(row['area_exact']), pix_width, factor=size_factor)
+        position = tuple(reference[2].all_world2pix([[row['l_cen'], row['b_cen']]], 0)[0])
+        base = Cutout2D(reference[0], position=position, size=(size, size),
+                        wcs=reference[2], copy=False)
+        cutouts = {names[0]: base}
+        for name in names[1:]:
+            data, header, mywcs = layers[name]
+            if same[name]:
+                cutouts[name] = Cutout2D(data, position=position, size=(size, size),
+                                         wcs=mywcs, copy=False)
+            else:
+                sky = SkyCoord(row['l_cen']*u.deg, row['b_cen']*u.deg,
+                               frame='galactic')
+                cutouts[name] = Cutout2D(data, position=sky,
+                                         size=size*pix_width*u.deg,
+                                         wcs=mywcs, copy=False)
+        yield row['_idx'], cutouts
+
+
+def cutout_hdu(cutout, header, hdu_class=fits.ImageHDU):
+    """HDU of a cutout, with the map's header and the cutout's WCS."""
+    header = header.copy()
+    header.update(cutout.wcs.to_header())
+    return hdu_class(data=cutout.data, header=header)
+
+
+def write_cutouts(cutouts, layers, out_dir, output='fits',
+                  archive_name='leaf_cutouts'):
+    """
+    Write the (number, cutouts) pairs of `leaf_cutouts`.
+
+    output='fits' writes one file per leaf and layer, <n>_cutout.fits for
+    the first layer and <n>_<name>_cutout.fits for the others.
+    output='mef' writes all of them as extensions LEAF<n>_<NAME> of a single
+    <archive_name>.fits, and output='hdf5' as datasets /<n>/<name> of
+    <archive_name>.hdf5 with the FITS header in their 'header' attribute.
+    Returns the list of files written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    names = list(layers)
+
+    if output == 'fits':
+        written = []
+        for number, leaf in cutouts:
+            for name in names:
+                filename = (str(number)+'_cutout.fits' if name == names[0]
+                            else str(number)+'_'+name+'_cutout.fits')
+                path = os.path.join(out_dir, filename)
+                cutout_hdu(leaf[name], layers[name][1],
+                           hdu_class=fits.PrimaryHDU).writeto(path, overwrite=True)
+                written.append(path)
+        return written
+
+    if output == 'mef':
+        path = os.path.join(out_dir, archive_name+'.fits')
+        hdus = [fits.PrimaryHDU()]
+        for number, leaf in cutouts:
+            for name in names:
+                hdu = cutout_hdu(leaf[name], layers[name][1])
+                hdu.header['EXTNAME'] = 'LEAF{0}_{1}'.format(number, name.upper())
+                hdu.header['LEAF'] = int(number)
+                hdu.header['LAYER'] = name
+                hdus.append(hdu)
+        fits.HDUList(hdus).writeto(path, overwrite=True)
+        return [path]
+
+    if output == 'hdf5':
+        import h5py
+        path = os.path.join(out_dir, archive_name+'.hdf5')
+        with h5py.File(path, 'w') as f:
+            for number, leaf in cutouts:
+                for name in names:
+                    hdu = cutout_hdu(leaf[name], layers[name][1])
+                    dset = f.create_dataset('{0}/{1}'.format(number, name),
+                                            data=hdu.data, compression='gzip')
+                    dset.attrs['header'] = hdu.header.tostring()
+        return [path]
+
+    raise ValueError("output must be 'fits', 'mef' or 'hdf5'")
@@ -0,0 +1,143 @@
+"""
+Compact, persistent index of the dendrogram leaves ('clouds').
+- An integer label map on the HiGAL grid (0 = no leaf, n = leaf number n).
+- Per-leaf bounding boxes, and the flat pixel indices of every leaf stored
+as one array sorted by leaf number.
+It is built once from the dendrogram (with the Brick swapped in from its
+separate dendrogram) and saved next to clouds_only_dendrogram.hdf5, so that
+the other scripts never need to call `get_mask()` or `indices()` per leaf.
+"""
+import os
+import hashlib
+import numpy as np
+from scipy import ndimage
+from astropy import wcs
+from astropy.io import fits
+from pipeline_cache import save_atomic
+
+
+class LeafIndex(object):
+    """
+    Label map, bounding boxes and pixel lists of a numbered set of leaves.
+    `pixels`/`offsets` and the bounding boxes (`views`, number -> slices)
+    are derived from `labels` unless given.
+    """
+
+    def __init__(self, labels, numbers, struct_idx, header=None, pixels=None,
+                 offsets=None, sources=None, views=None):
+        self.labels = labels
+        self.numbers = np.asarray(numbers)
+        self.struct_idx = np.asarray(struct_idx)
+        self.header = header
+        # Where each leaf comes from, e.g. 'clouds_only_dendrogram.hdf5:123'
+        self.sources = (np.asarray(sources, dtype=str) if sources is not None
+                        else np.array([''] * len(self.numbers)))
+        nlab = max(labels.max(), self.numbers.max()) + 1
+
+        if pixels is None:
+            flat = labels.ravel()
+            counts = np.bincount(flat, minlength=nlab)
+            pixels = np.argsort(flat, kind='stable')[counts[0]:]
+            offsets = np.concatenate([[0], np.cumsum(counts[1:])])
+        self.pixels = pixels
+        self.offsets = offsets
+
+        if views is None:
+            objects = ndimage.find_objects(labels, max_label=nlab-1)
+            views = dict((n, objects[n-1]) for n in self.numbers
+                         if objects[n-1] is not None)
+        self.views = views
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+    @property
+    def wcs(self):
+        return wcs.WCS(self.header) if self.header is not None else None
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def leaf_pixels(self, number):
+        """Flat (raveled) pixel indices of leaf `number`."""
+        return self.pixels[self.offsets[number-1]:self.offsets[number]]
+
+    def indices(self, number):
+        """(y, x) pixel indices of leaf `number`, as `Structure.indices()`."""
+        return np.unravel_index(self.leaf_pixels(number), self.shape)
+
+    def submask(self, number):
+        """Boolean mask of leaf `number` cropped to its bounding box."""
+        return self.labels[self.views[number]] == number
+
+    def leaf_set(self):
+        """(number, view, submask) of every leaf, in leaf-number order."""
+        return [(n, self.views[n], self.submask(n))
+                for n in self.numbers if n in self.views]
+
+    def digest(self):
+        """SHA-256 of the labels and numbering, for cache keys."""
+        sha = hashlib.sha256(np.ascontiguousarray(self.labels).tobytes())
+        sha.update(np.ascontiguousarray(self.numbers).tobytes())
+        return sha.hexdigest()
+
+    def save(self, path):
+        save_atomic(path, np.savez_compressed, labels=self.labels, numbers=self.numbers,
+                    struct_idx=self.struct_idx, pixels=self.pixels,
+                    offsets=self.offsets, sources=self.sources,
+                    header=(self.header.tostring()
+                            if self.header is not None else ''))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            header = str(f['header'])
+            return cls(f['labels'], f['numbers'], f['struct_idx'],
+                       header=fits.Header.fromstring(header) if header else None,
+                       pixels=f['pixels'], offsets=f['offsets'],
+                       sources=f['sources'] if 'sources' in f else None)
+
+
+def leaf_index_path(dendro_file):
+    """
+    Where the leaf index of a dendrogram file is kept, e.g.
+    clouds_only_dendrogram.hdf5 -> clouds_only_leaf_index.npz
+    """
+    root = os.path.splitext(dendro_file)[0]
+    if root.endswith('_dendrogram'):
+        root = root[:-len('_dendrogram')]
+    return root + '_leaf_index.npz'
+
+
+def build_leaf_index(dend, leaves, replace=None, add=None, header=None,
+                     sources=None):
+    """
+    Number `leaves` from 1 and build their label map from the dendrogram's
+    `index_map`, in one vectorised lookup.
+
+    `replace` maps a structure idx in `leaves` to (dendrogram, structure)
+    taken from another dendrogram on the same grid, which then takes that
+    leaf's number (this is how the Brick is swapped in). `add` is a list of
+    (dendrogram, structure) appended as new leaves after the others; their
+    pixels take precedence over any leaf they overlap. `sources` optionally
+    names each of `leaves`, then each of `add`, for the index's provenance.
+    """
+    replace = replace or {}
+    add = add or []
+    lookup = np.zeros(max(s.idx for s in dend.all_structures) + 2, dtype=np.int32)
+    numbers = np.arange(1, len(leaves)+len(add)+1)
+    struct_idx = np.array([leaf.idx for leaf in leaves] +
+                          [structure.idx for aux_dend, structure in add], dtype=int)
+    lookup[struct_idx[:len(leaves)] + 1] = numbers[:len(leaves)]
+    labels = lookup[dend.index_map + 1]
+
+    for idx, (aux_dend, structure) in replace.items():
+        number = numbers[:len(leaves)][struct_idx[:len(leaves)] == idx][0]
+        labels[labels == number] = 0
+        labels[aux_dend.index_map == structure.idx] = number
+
+    for number, (aux_dend, structure) in zip(numbers[len(leaves):], add):
+        labels[aux_dend.index_map == structure.idx] = number
+
+    return LeafIndex(labels, numbers, struct_idx, header=header, sources=sources)
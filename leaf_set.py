@@ -0,0 +1,113 @@
+"""
+The merged set of leaves ('clouds') that every stage works on.
+- Defined once in `leaf_set_config`: the leaves taken from the main
+dendrogram, the structures of auxiliary dendrograms that replace some of
+them (the Brick, which had to be extracted from a separate dendrogram) and
+any structures added from auxiliary dendrograms.
+- Built once by Run_dendrogram_and_catalogue.py and saved as the leaf index
+(label map, bounding boxes, pixel lists, provenance of each leaf) plus its
+catalogue rows, next to the dendrogram.
+- Downstream scripts call `load_leaf_set()` instead of loading the Brick
+dendrogram and patching it into their own leaf lists.
+"""
+import os
+import astrodendro
+from astropy.table import Table
+from leaf_index import LeafIndex, build_leaf_index, leaf_index_path
+from pipeline_cache import save_atomic
+# _____________________________________
+
+leaf_set_config = {
+    'dendrogram': './../Dendrogram_files/clouds_only_dendrogram.hdf5',
+    # dend.leaves[first:len(dend.leaves)-last]
+    'first': 9,
+    'last': 3,
+    # Structure idx in the main dendrogram -> structure of another dendrogram
+    'replace': [{'idx': 45,
+                 'dendrogram': './../Dendrogram_files/separate_brick16_dendrogram.fits',
+                 'leaf': -5}],
+    # Extra leaves, numbered after the others
+    'add': [],
+}
+
+
+def leaf_set_paths(config=leaf_set_config):
+    """Leaf index and catalogue files of a leaf set."""
+    index_file = leaf_index_path(config['dendrogram'])
+    return index_file, index_file.replace('_leaf_index.npz', '_leaf_catalogue.ecsv')
+
+
+def leaf_set_key(cache, config=leaf_set_config):
+    """
+    Key of a leaf set in a PipelineCache `cache`, from the dendrograms it is
+    taken from and its config. Outputs indexed by leaf number (such as the
+    catalogue) are recorded under it, so later stages can tell whether they
+    still match the current dendrogram.
+    """
+    files = [config['dendrogram']] + [entry['dendrogram']
+                                      for entry in config['replace'] + config['add']]
+    return cache.key(files, config)
+
+
+def build_leaf_set(config=leaf_set_config, dend=None, header=None):
+    """
+    LeafIndex of the leaf set described by `config`. The main dendrogram is
+    loaded unless given as `dend`; each auxiliary dendrogram is loaded once.
+    """
+    if dend is None:
+        dend = astrodendro.Dendrogram.load_from(config['dendrogram'])
+    if header is None and dend.wcs is not None:
+        header = dend.wcs.to_header()
+
+    aux = {}
+
+    def structure(entry):
+        if entry['dendrogram'] not in aux:
+            aux[entry['dendrogram']] = astrodendro.Dendrogram.load_from(entry['dendrogram'])
+        aux_dend = aux[entry['dendrogram']]
+        return aux_dend, aux_dend.leaves[entry['leaf']]
+
+    def source(filename, description):
+        return os.path.basename(filename) + ':' + description
+
+    leaves = dend.leaves[config['first']:(len(dend.leaves)-config['last'])]
+    replace = dict((entry['idx'], structure(entry)) for entry in config['replace'])
+    add = [structure(entry) for entry in config['add']]
+
+    sources = []
+    for leaf in leaves:
+        entry = [e for e in config['replace'] if e['idx'] == leaf.idx]
+        sources.append(source(entry[0]['dendrogram'], 'leaves[{0}]'.format(entry[0]['leaf']))
+                       if entry else source(config['dendrogram'], str(leaf.idx)))
+    sources += [source(entry['dendrogram'], 'leaves[{0}]'.format(entry['leaf']))
+                for entry in config['add']]
+
+    return build_leaf_index(dend, leaves, replace=replace, add=add, header=header,
+                            sources=sources)
+
+
+def save_leaf_set(index, catalogue=None, config=leaf_set_config):
+    """Save the leaf index and, if given, its catalogue rows."""
+    index_file, catalogue_file = leaf_set_paths(config)
+    index.save(index_file)
+    if catalogue is not None:
+        save_atomic(catalogue_file, catalogue.write, format='ascii.ecsv',
+                    overwrite=True)
+
+
+def load_leaf_set(config=leaf_set_config, catalogue=False):
+    """
+    The saved leaf index (built and saved first if missing), and with
+    catalogue=True also its catalogue rows (None if not written yet).
+    """
+    index_file, catalogue_file = leaf_set_paths(config)
+    if os.path.exists(index_file):
+        index = LeafIndex.load(index_file)
+    else:
+        index = build_leaf_set(config)
+        save_leaf_set(index, config=config)
+    if not catalogue:
+        return index
+    cat = (Table.read(catalogue_file, format='ascii.ecsv')
+           if os.path.exists(catalogue_file) else None)
+    return index, cat
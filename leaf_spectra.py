@@ -0,0 +1,181 @@
+"""
+Leaf and background mean spectra straight from a survey cube on the HiGAL grid.
+- Streams the cube in chunks of spectral channels, once.
+- Uses a single integer label image (0 = no leaf, n = leaf number) instead of
+one boolean mask per leaf, so the on-source sums of every leaf come from one
+`bincount` per chunk.
+- The background ('inverted') spectra, i.e. the leaf bounding box minus the
+leaf, come from a summed-area table of each channel, so they are obtained in
+the same pass without building any sub-cubes. Other background regions
+(shells, annuli, see background_regions.py) are summed in the same pass
+through a sparse pixel-to-region weight matrix.
+- `weighted_mean_spectra` averages a cube on its own (native) grid with
+fractional pixel weights instead, e.g. the coverage of each leaf from
+mask_regrid.leaf_coverage, so the cube never has to be reprojected.
+"""
+import numpy as np
+from scipy import sparse
+from astropy import wcs
+from spectral_cube.lower_dimensional_structures import OneDSpectrum
+
+
+def _box_sums(sat, views):
+    """
+    Sums over each (y, x) view from a summed-area table of shape
+    (nchan, ny+1, nx+1). Returns an array of shape (nchan, nviews).
+    """
+    y0, y1, x0, x1 = np.array([(v[0].start, v[0].stop, v[1].start, v[1].stop)
+                               for v in views]).T
+    return sat[:, y1, x1] - sat[:, y0, x1] - sat[:, y1, x0] + sat[:, y0, x0]
+
+
+def _summed_area_table(data):
+    sat = np.zeros((data.shape[0], data.shape[1]+1, data.shape[2]+1))
+    np.cumsum(np.cumsum(data, axis=1), axis=2, out=sat[:, 1:, 1:])
+    return sat
+
+
+def leaf_mean_spectra(cube, labels, views, backgrounds=None, chunk_size=32):
+    """
+    On-source and background mean spectra of every leaf in `labels`.
+
+    Parameters
+    ----------
+    cube : SpectralCube
+        Cube on the same spatial grid as `labels`. Masked and NaN pixels are
+        ignored, as in ``cube.mean(axis=(1,2))``.
+    labels : 2D int ndarray
+        Leaf label image, 0 outside the leaves.
+    views : dict
+        Leaf number -> (y, x) slices of its bounding box.
+    backgrounds : dict, optional
+        Leaf number -> (view, mask) of its background region (see
+        background_regions.py). By default the background is the rest of
+        the leaf's bounding box.
+    chunk_size : int
+        Number of spectral channels held in memory at a time.
+
+    Returns
+    -------
+    numbers : 1D ndarray
+        Leaf numbers, sorted, giving the row order of the spectra.
+    on, bg : 2D ndarray
+        Mean spectra over the leaf and over its background region,
+        shape (len(numbers), nchan).
+    """
+    numbers = np.array(sorted(views))
+    leaf_views = [views[n] for n in numbers]
+    nlab = max(labels.max(), numbers.max()) + 1
+
+    flat_labels = labels.ravel()
+    in_leaf = flat_labels > 0
+    leaf_labels = flat_labels[in_leaf]
+
+    nchan = cube.shape[0]
+    on_sum = np.zeros((nchan, nlab))
+    on_count = np.zeros((nchan, nlab))
+    box_sum = np.zeros((nchan, len(numbers)))
+    box_count = np.zeros((nchan, len(numbers)))
+    if backgrounds is not None:
+        matrix, (yv, xv) = _region_matrix([backgrounds[n] for n in numbers])
+
+    for c0 in range(0, nchan, chunk_size):
+        c1 = min(c0 + chunk_size, nchan)
+        data = cube.filled_data[c0:c1].value
+        finite = np.isfinite(data)
+        data = np.where(finite, data, 0.)
+
+        nc = c1 - c0
+        bins = (np.arange(nc)[:, None] * nlab + leaf_labels[None, :]).ravel()
+        on_sum[c0:c1] = np.bincount(bins, weights=data.reshape(nc, -1)[:, in_leaf].ravel(),
+                                    minlength=nc*nlab).reshape(nc, nlab)
+        on_count[c0:c1] = np.bincount(bins, weights=finite.reshape(nc, -1)[:, in_leaf].ravel(),
+                                      minlength=nc*nlab).reshape(nc, nlab)
+
+        if backgrounds is None:
+            box_sum[c0:c1] = _box_sums(_summed_area_table(data), leaf_views)
+            box_count[c0:c1] = _box_sums(_summed_area_table(finite), leaf_views)
+        else:
+            box_sum[c0:c1], box_count[c0:c1] = _region_sums(
+                matrix, data[:, yv, xv].reshape(nc, -1), finite[:, yv, xv].reshape(nc, -1))
+
+    on_sum = on_sum[:, numbers]
+    on_count = on_count[:, numbers]
+    if backgrounds is None:
+        bg_sum = box_sum - on_sum
+        bg_count = np.around(box_count - on_count)
+    else:
+        bg_sum, bg_count = box_sum, box_count
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        on = np.where(on_count > 0, on_sum / on_count, np.nan)
+        bg = np.where(bg_count > 0, bg_sum / bg_count, np.nan)
+    return numbers, on.T, bg.T
+
+
+def _region_matrix(regions):
+    """
+    Sparse weight matrix, shape (npix, len(regions)), of `regions`, a list of
+    (view, weights), over the box enclosing them. Returns the matrix and that
+    box as (y, x) slices.
+    """
+    y0 = min(v[0].start for v, w in regions)
+    y1 = max(v[0].stop for v, w in regions)
+    x0 = min(v[1].start for v, w in regions)
+    x1 = max(v[1].stop for v, w in regions)
+
+    rows, cols, vals = [], [], []
+    for i, (view, weights) in enumerate(regions):
+        yy, xx = np.mgrid[view[0].start-y0:view[0].stop-y0,
+                          view[1].start-x0:view[1].stop-x0]
+        keep = np.ravel(weights) != 0
+        rows.append(np.ravel_multi_index((yy.ravel()[keep], xx.ravel()[keep]),
+                                         (y1-y0, x1-x0)))
+        cols.append(np.full(keep.sum(), i))
+        vals.append(np.ravel(weights)[keep].astype(float))
+    matrix = sparse.csr_matrix((np.concatenate(vals),
+                                (np.concatenate(rows), np.concatenate(cols))),
+                               shape=((y1-y0)*(x1-x0), len(regions)))
+    return matrix, (slice(y0, y1), slice(x0, x1))
+
+
+def _region_sums(matrix, data, finite):
+    """Weighted sums and weights of a (nchan, npix) chunk over each region."""
+    return (matrix.T.dot(data.T).T, matrix.T.dot(finite.T.astype(float)).T)
+
+
+def weighted_mean_spectra(cube, regions, chunk_size=32):
+    """
+    Weighted mean spectra of `cube` over each of `regions`, a list of
+    (view, weights) on the cube's spatial grid. Each channel is averaged as
+    sum(w * data) / sum(w) over its finite, unmasked pixels.
+
+    The cube is streamed once, `chunk_size` channels at a time, reading only
+    the box enclosing all regions, and the sums of all regions come from one
+    sparse matrix product per chunk. Returns an array (len(regions), nchan).
+    """
+    nchan = cube.shape[0]
+    if not regions:
+        return np.zeros((0, nchan))
+    matrix, (yv, xv) = _region_matrix(regions)
+
+    total = np.zeros((nchan, len(regions)))
+    weight = np.zeros((nchan, len(regions)))
+    for c0 in range(0, nchan, chunk_size):
+        c1 = min(c0 + chunk_size, nchan)
+        data = cube.filled_data[c0:c1, yv, xv].value.reshape(c1-c0, -1)
+        finite = np.isfinite(data)
+        total[c0:c1], weight[c0:c1] = _region_sums(matrix, np.where(finite, data, 0.),
+                                                   finite)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weight > 0, total / weight, np.nan).T
+
+
+def mean_spectrum(cube, values):
+    """
+    Wrap `values` as a 1-D spectrum carrying the spectral axis and unit of
+    `cube`, ready to be written to the same FITS format as
+    ``cube.mean(axis=(1,2))``.
+    """
+    return OneDSpectrum(values, unit=cube.unit, wcs=cube.wcs.sub([wcs.WCSSUB_SPECTRAL]))
@@ -0,0 +1,101 @@
+"""
+Per-leaf statistics of auxiliary maps (dust temperature, column density,
+integrated intensity, ...) for every leaf at once.
+- Gathers the map values of all leaves with the pixel lists of the leaf index,
+then sorts them once within each leaf.
+- Max, mean, median, percentiles and NaN-aware counts for every leaf come out
+of that single pass as catalogue columns, instead of a Python loop calling
+np.nanmax / np.nanmean / np.nanmedian per leaf.
+"""
+import numpy as np
+from astropy.table import Table, Column
+
+
+def _grouped_quantile(sorted_values, start, nfinite, q):
+    """
+    Linearly interpolated quantile `q` (0-1) of each group in
+    `sorted_values`, as np.nanpercentile does. Groups start at `start` and
+    have their `nfinite` finite values first.
+    """
+    pos = start + q * np.maximum(nfinite - 1, 0)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    frac = pos - lo
+    result = sorted_values[lo] * (1 - frac) + sorted_values[hi] * frac
+    return np.where(nfinite > 0, result, np.nan)
+
+
+def grouped_statistics(values, offsets, percentiles=(16, 84)):
+    """
+    Peak, mean, median and `percentiles` of the finite values of each group
+    of `values`, group i covering offsets[i]:offsets[i+1], from one sort.
+
+    Returns a dict of 'peak', 'mean', 'median', 'p<q>' for each of
+    `percentiles` and 'nfinite' -> array with one entry per group (NaN for
+    groups without finite values).
+    """
+    values = np.asarray(values, dtype=float)
+    npix = np.diff(offsets)
+    start = np.asarray(offsets[:-1])
+    group = np.repeat(np.arange(len(npix)), npix)
+
+    finite = np.isfinite(values)
+    nfinite = np.bincount(group[finite], minlength=len(npix))
+    total = np.bincount(group[finite], weights=values[finite], minlength=len(npix))
+
+    # Sort within each group; NaNs sort to the end of their group.
+    sorted_values = values[np.lexsort((values, group))]
+    if sorted_values.size == 0:
+        sorted_values = np.array([np.nan])
+    start = np.minimum(start, sorted_values.size - 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = {'peak': np.where(nfinite > 0,
+                                  sorted_values[np.maximum(start + nfinite - 1, 0)],
+                                  np.nan),
+                 'mean': np.where(nfinite > 0, total / nfinite, np.nan),
+                 'median': _grouped_quantile(sorted_values, start, nfinite, 0.5)}
+    for q in percentiles:
+        stats['p{0:g}'.format(q)] = _grouped_quantile(sorted_values, start, nfinite,
+                                                      q / 100.)
+    stats['nfinite'] = nfinite
+    return stats
+
+
+def leaf_map_statistics(index, data, name, unit=None, percentiles=(16, 84)):
+    """
+    Statistics of map `data` (on the grid of `index`) over every leaf.
+
+    Returns a Table with one row per leaf, in leaf-number order, with an
+    `_idx` column holding the leaf number and the columns
+    `peak_<name>`, `mean_<name>`, `median_<name>`, `p<q>_<name>` for each of
+    `percentiles`, `nfinite_<name>` and `nnan_<name>`.
+    """
+    stats = grouped_statistics(data.ravel()[index.pixels], index.offsets,
+                               percentiles=percentiles)
+    npix = np.diff(index.offsets)
+
+    rows = index.numbers - 1
+    table = Table()
+    table.add_column(Column(data=index.numbers, name='_idx'))
+    for stat in ['peak', 'mean', 'median'] + ['p{0:g}'.format(q) for q in percentiles]:
+        table.add_column(Column(data=stats[stat][rows], name=stat+'_'+name, unit=unit))
+    table.add_column(Column(data=stats['nfinite'][rows], name='nfinite_'+name))
+    table.add_column(Column(data=(npix - stats['nfinite'])[rows], name='nnan_'+name))
+    return table
+
+
+def leaf_statistics(index, maps, percentiles=(16, 84)):
+    """
+    `leaf_map_statistics` for several maps, merged into one Table.
+    `maps` is a dict of name -> map, or name -> (map, unit).
+    """
+    table = Table()
+    table.add_column(Column(data=index.numbers, name='_idx'))
+    for name, value in maps.items():
+        data, unit = value if isinstance(value, tuple) else (value, None)
+        stats = leaf_map_statistics(index, data, name, unit=unit,
+                                    percentiles=percentiles)
+        for colname in stats.colnames[1:]:
+            table.add_column(stats[colname])
+    return table
@@ -0,0 +1,163 @@
+"""
+Projects the leaf label map from the HiGAL grid onto the spatial grid of a
+survey cube, in plain Python (no CASA imregrid / exportfits round-trip).
+- 'nearest' takes the label of the HiGAL pixel nearest to each survey pixel.
+- 'exact' computes, with reproject_exact, the fraction of each survey pixel
+covered by each leaf (working on each leaf's footprint only), and labels a
+pixel with the leaf covering most of it, if that covers at least
+`threshold` of it. The fractions themselves are available from
+`leaf_coverage`.
+- Leaf numbers are kept as integer labels (0 = no leaf), instead of a single
+0/1 mask.
+- Results are cached per leaf index, target WCS and method, so regridding
+for APEX and MALT90 again is just a file read.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+from reproject import reproject_interp, reproject_exact
+from background_regions import INVERTED, background_regions
+from pipeline_cache import save_atomic
+
+
+def target_grid(filename):
+    """Celestial WCS and (ny, nx) spatial shape of a survey image or cube."""
+    header = fits.getheader(filename)
+    return WCS(header).celestial, (header['NAXIS2'], header['NAXIS1'])
+
+
+def covering_view(view_wcs, view, grid_wcs, grid_shape, margin=2, nsamp=5):
+    """
+    Pixel region of the celestial grid (`grid_wcs`, `grid_shape`) that covers
+    `view` of the grid of `view_wcs`, padded by `margin` pixels. The view is
+    sampled on an `nsamp` x `nsamp` grid of positions (edges included) so
+    that rotated or differently projected grids are still covered.
+    """
+    ys = np.linspace(view[0].start - 0.5, view[0].stop - 0.5, nsamp)
+    xs = np.linspace(view[1].start - 0.5, view[1].stop - 0.5, nsamp)
+    xx, yy = np.meshgrid(xs, ys)
+    coords = view_wcs.celestial.pixel_to_world(xx.ravel(), yy.ravel())
+    x, y = grid_wcs.celestial.world_to_pixel(coords)
+
+    ny, nx = grid_shape
+    x0 = min(max(int(np.floor(np.nanmin(x))) - margin, 0), nx - 1)
+    y0 = min(max(int(np.floor(np.nanmin(y))) - margin, 0), ny - 1)
+    x1 = max(min(int(np.ceil(np.nanmax(x))) + margin + 1, nx), x0 + 1)
+    y1 = max(min(int(np.ceil(np.nanmax(y))) + margin + 1, ny), y0 + 1)
+    return slice(y0, y1), slice(x0, x1)
+
+
+def _cache_file(cache_dir, index, target_wcs, shape_out, params, suffix):
+    description = json.dumps({'index': index.digest(),
+                              'target': target_wcs.to_header_string(),
+                              'shape': list(shape_out), 'params': params},
+                             sort_keys=True)
+    key = hashlib.sha256(description.encode()).hexdigest()[:24]
+    return os.path.join(cache_dir, key + suffix)
+
+
+def region_coverage(regions, source_wcs, target_wcs, shape_out):
+    """
+    Fraction of each target pixel covered by each of `regions`, a list of
+    (number, view, weights) on the source grid (weights being a boolean or
+    fractional mask over `view`). Only the target pixels around each region
+    are computed. Returns a list of (number, target view, fraction), leaving
+    out regions that fall outside the target grid.
+    """
+    coverage = []
+    for number, view, weights in regions:
+        tview = covering_view(source_wcs, view, target_wcs, shape_out, margin=1)
+        fraction, footprint = reproject_exact(
+            (np.asarray(weights, dtype=float), source_wcs[view]), target_wcs[tview],
+            shape_out=(tview[0].stop - tview[0].start, tview[1].stop - tview[1].start))
+        # reproject_exact averages over the covered part of each pixel;
+        # times the footprint it becomes the covered fraction of the pixel.
+        fraction = np.nan_to_num(fraction * footprint)
+        if fraction.any():
+            coverage.append((number, tview, fraction))
+    return coverage
+
+
+def leaf_coverage(index, target_wcs, shape_out, region='leaf', background=INVERTED,
+                  cache_dir=None):
+    """
+    Fraction of each target pixel covered by each leaf (region='leaf'), or
+    by its background region (region='background'), `background` being the
+    keyword arguments of `background_regions.background_regions`.
+
+    Returns a list of (number, view, fraction), as `LeafIndex.leaf_set()`
+    but on the target grid: `fraction` is a float array over `view` of the
+    target grid. Leaves falling outside the target grid are left out.
+    """
+    if cache_dir is not None:
+        path = _cache_file(cache_dir, index, target_wcs, shape_out,
+                           {'coverage': 'exact', 'region': region,
+                            'background': background if region == 'background' else None},
+                           '.npz')
+        if os.path.exists(path):
+            with np.load(path) as f:
+                return [(int(n), (slice(b[0], b[1]), slice(b[2], b[3])),
+                         f['fractions'][f['offsets'][i]:f['offsets'][i+1]].reshape(
+                             b[1]-b[0], b[3]-b[2]))
+                        for i, (n, b) in enumerate(zip(f['numbers'], f['boxes']))]
+
+    if region == 'leaf':
+        regions = index.leaf_set()
+    elif region == 'background':
+        regions = background_regions(index, **background)
+    else:
+        raise ValueError("region must be 'leaf' or 'background'")
+    coverage = region_coverage(regions, index.wcs.celestial, target_wcs, shape_out)
+
+    if cache_dir is not None:
+        boxes = np.array([[v[0].start, v[0].stop, v[1].start, v[1].stop]
+                          for n, v, f in coverage], dtype=int).reshape(-1, 4)
+        offsets = np.concatenate([[0], np.cumsum([f.size for n, v, f in coverage])])
+        save_atomic(path, np.savez_compressed,
+                     numbers=np.array([n for n, v, f in coverage], dtype=int),
+                     boxes=boxes, offsets=offsets,
+                     fractions=(np.concatenate([f.ravel() for n, v, f in coverage])
+                                if coverage else np.zeros(0)))
+    return coverage
+
+
+def regrid_labels(index, target_wcs, shape_out, method='nearest', threshold=0.5,
+                  cache_dir=None):
+    """
+    Leaf label map of `index` on the target grid (int32, 0 = no leaf), with
+    method 'nearest' or 'exact' (see the module docstring).
+    """
+    if cache_dir is not None:
+        path = _cache_file(cache_dir, index, target_wcs, shape_out,
+                           {'method': method, 'threshold': threshold}, '.npy')
+        if os.path.exists(path):
+            return np.load(path)
+
+    if method == 'nearest':
+        labels, footprint = reproject_interp(
+            (index.labels.astype(float), index.wcs.celestial), target_wcs,
+            shape_out=shape_out, order='nearest-neighbor')
+        labels = np.where(np.isfinite(labels), labels, 0).astype(np.int32)
+    elif method == 'exact':
+        labels = np.zeros(shape_out, dtype=np.int32)
+        best = np.zeros(shape_out)
+        for number, view, fraction in leaf_coverage(index, target_wcs, shape_out,
+                                                    cache_dir=cache_dir):
+            better = fraction > best[view]
+            labels[view][better] = number
+            best[view][better] = fraction[better]
+        labels[best < threshold] = 0
+    else:
+        raise ValueError("method must be 'nearest' or 'exact'")
+
+    if cache_dir is not None:
+        save_atomic(path, np.save, labels)
+    return labels
+
+
+def label_hdu(labels, target_wcs):
+    """Integer label map as a FITS HDU on the target grid."""
+    return fits.PrimaryHDU(labels, target_wcs.to_header())
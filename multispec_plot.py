@@ -1,114 +1,38 @@
 """
 Plots a 6-panel figure displaying spectra and background-subtracted spectra
 for each dendrogram leaf and all molecular line tracers in our sample.
+The panels are set in `panels` below and drawn from the spectrum stores
+written by extract_leaf_cubes.py (see spectrum_figures.py).
 """
 import os
-import re
-import numpy as np
-import pylab as pl
-import glob
-import pyspeckit
-from astropy.table import Table
-from astropy import units as u
-import matplotlib
-matplotlib.rc('xtick', labelsize=8)
-matplotlib.rc('ytick', labelsize=8)
-
-for i in range(1,23):
-
-    if i==3:
-        continue
-    else:
-        fig = pl.figure(1)
-        fig.clf()
-
-        ax = pl.subplot(3,2,1)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/meanspec/"+str(i)+"_HCN_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/Inverted/meanspec/"+str(i)+"_HCN_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.axes.get_xaxis().set_visible(False)
-        ax.set_ylabel("")
-        ax.text(0.02, 0.95, "HCN",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.set_xlim(-200,200)
-
-        ax = pl.subplot(3,2,2)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/meanspec/"+str(i)+"_HC3N_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/Inverted/meanspec/"+str(i)+"_HC3N_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.axes.get_xaxis().set_visible(False)
-        ax.set_ylabel("")
-        ax.text(0.02, 0.95, "HC$_{3}$N",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.annotate("-  Data", xy=(0.77, 0.92), xycoords='axes fraction', size=6)
-        ax.annotate("-- Data - BG", xy=(0.77, 0.84), xycoords='axes fraction', size=6)
-        ax.set_xlim(-200,200)
-
-        ax = pl.subplot(3,2,3)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/meanspec/"+str(i)+"_HNCO_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_MALT90/Inverted/meanspec/"+str(i)+"_HNCO_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.set_ylabel("")
-        ax.axes.get_xaxis().set_visible(False)
-        ax.text(0.02, 0.95, "HNCO",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.set_xlim(-200,200)
-
-        ax = pl.subplot(3,2,4)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_APEX/meanspec/"+str(i)+"_13CO_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_APEX/Inverted/meanspec/"+str(i)+"_13CO_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.axes.get_xaxis().set_visible(False)
-        ax.set_ylabel("")
-        ax.text(0.02, 0.95, "$^{13}$CO",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.set_xlim(-200,200)
-
-        ax = pl.subplot(3,2,5)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_APEX/meanspec/"+str(i)+"_C18O_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_APEX/Inverted/meanspec/"+str(i)+"_C18O_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.xaxis.label.set_visible(False)
-        ax.set_ylabel("")
-        ax.text(0.02, 0.95, "C$^{18}$O",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.set_xlim(-200,200)
-
-        ax = pl.subplot(3,2,6)
-        sp = pyspeckit.Spectrum("./../Leaf_cubes_APEX/meanspec/"+str(i)+"_H2CO_303_202_cube_meanspec.fits")
-        sp_inv = pyspeckit.Spectrum("./../Leaf_cubes_APEX/Inverted/meanspec/"+str(i)+"_H2CO_303_202_cube_meanspec.fits")
-        sp2 = sp - sp_inv
-        sp2.plotter(figure=fig, axis=ax, clear=False, linestyle='--')
-        sp.plotter(figure=fig, axis=ax, clear=False)
-        ax.set_ylabel("")
-        ax.xaxis.label.set_visible(False)
-        ax.text(0.02, 0.95, "H$_{2}$CO$_{303-202}$",
-        verticalalignment='top', horizontalalignment='left',
-        transform=ax.transAxes,
-        color='black', fontsize=8)
-        ax.set_xlim(-200,200)
-
-        fig.text(0.5, 0.02, 'Velocity (km/s)', ha='center', fontsize=10)
-        fig.text(0.04, 0.5, 'Brightness Temperature (K)', va='center', rotation='vertical', fontsize=10)
-        sp.plotter.savefig("./../Figs/Multispec/bg-sub/"+str(i)+"_multispec.pdf")
-        fig.clf()
+from extract_leaf_cubes import surveys
+from spectrum_store import spectrum_store_path
+from spectrum_figures import render_leaf_figures
+# _____________________________________
+
+# Panels in reading order, on a `layout` (rows, columns) grid.
+layout = (3, 2)
+panels = [
+    {'survey': 'MALT90', 'molecule': 'HCN', 'label': "HCN", 'xlim': (-200, 200)},
+    {'survey': 'MALT90', 'molecule': 'HC3N', 'label': "HC$_{3}$N", 'xlim': (-200, 200),
+     'legend': True},
+    {'survey': 'MALT90', 'molecule': 'HNCO', 'label': "HNCO", 'xlim': (-200, 200)},
+    {'survey': 'APEX', 'molecule': '13CO', 'label': "$^{13}$CO", 'xlim': (-200, 200)},
+    {'survey': 'APEX', 'molecule': 'C18O', 'label': "C$^{18}$O", 'xlim': (-200, 200)},
+    {'survey': 'APEX', 'molecule': 'H2CO_303_202', 'label': "H$_{2}$CO$_{303-202}$",
+     'xlim': (-200, 200)},
+]
+
+# Leaves to plot (leaf 3 is left out, as before)
+leaves = [i for i in range(1, 23) if i != 3]
+
+out_dir = "./../Figs/Multispec/bg-sub/"
+# 'pdf' (one file per leaf, <leaf>_multispec.pdf), 'png', 'multipage' (one
+# multispec.pdf with a page per leaf) or 'atlas' (PNG pages of several leaves)
+output = 'pdf'
+n_workers = os.cpu_count()
+
+if __name__ == "__main__":
+    stores = dict((survey['name'], spectrum_store_path(survey)) for survey in surveys)
+    render_leaf_figures(stores, panels, leaves, out_dir, output=output,
+                        layout=layout, n_workers=n_workers)
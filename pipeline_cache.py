@@ -0,0 +1,145 @@
+"""
+Content-addressed cache for the pipeline stages.
+- Each artifact (a dendrogram, the leaf cubes of one survey line, a mean
+spectrum, the fit table, ...) is recorded with a key made from the SHA-256
+of its input files plus the stage parameters.
+- A stage is skipped when the recorded key still matches and all of its
+outputs exist, so after changing one molecule or one threshold only the
+affected artifacts are recomputed.
+- File hashes are remembered by (size, mtime), so unchanged survey cubes are
+not re-read just to hash them. The memo is kept in memory and written once
+by `flush()`, which each stage calls when it is done.
+- `save_atomic` writes a file through a temporary file next to it, so an
+interrupted stage never leaves a half-written output behind. It is used for
+the artifacts later stages read back: the leaf index and catalogue, leaf
+cubes, mean spectra, spectrum stores, coverage maps, the fit table and the
+cache's own JSON files. Figures and cutouts are written directly.
+"""
+import os
+import re
+import json
+import hashlib
+import tempfile
+
+
+def _file_mode(path):
+    """Permission bits for a file written to `path`."""
+    if os.path.exists(path):
+        return os.stat(path).st_mode & 0o7777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def save_atomic(path, save, *args, **kwargs):
+    """
+    Call `save(tmp_path, *args, **kwargs)` on a temporary file next to
+    `path`, with the same extension, and move it into place. The temporary
+    file is removed if `save` fails. The file gets the mode of the file it
+    replaces, or else the usual one for a new file under the current umask
+    (mkstemp would leave it readable by its owner only).
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix=os.path.splitext(path)[1], prefix='.tmp-',
+                                    dir=directory)
+    os.close(fd)
+    try:
+        save(tmp_path, *args, **kwargs)
+        os.chmod(tmp_path, _file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json(path, obj):
+    """Write `obj` to the JSON file `path` with `save_atomic`."""
+    def dump(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, indent=1, sort_keys=True)
+    save_atomic(path, dump)
+
+
+class PipelineCache(object):
+    """
+    Manifest store for pipeline artifacts, kept under `root`.
+    """
+
+    def __init__(self, root='./../Cache'):
+        self.root = os.path.abspath(root)
+        os.makedirs(os.path.join(self.root, 'manifests'), exist_ok=True)
+        self._hashes_file = os.path.join(self.root, 'file_hashes.json')
+        self._hashes = {}
+        self._dirty = False
+        if os.path.exists(self._hashes_file):
+            with open(self._hashes_file) as f:
+                self._hashes = json.load(f)
+
+    def file_hash(self, path):
+        """
+        SHA-256 of a file's contents, reused while its size and mtime are
+        unchanged.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self._hashes.get(path)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['sha256']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha.update(block)
+        self._hashes[path] = {'stamp': stamp, 'sha256': sha.hexdigest()}
+        self._dirty = True
+        return sha.hexdigest()
+
+    def flush(self):
+        """Write the file hashes computed since the last flush to disk."""
+        if self._dirty:
+            write_json(self._hashes_file, self._hashes)
+            self._dirty = False
+
+    def key(self, inputs, params):
+        """
+        Cache key of an artifact from its input files and parameters.
+        """
+        description = {'inputs': [self.file_hash(p) for p in inputs],
+                       'params': params}
+        return hashlib.sha256(json.dumps(description, sort_keys=True,
+                                         default=str).encode()).hexdigest()
+
+    def _manifest(self, artifact):
+        name = re.sub('[^A-Za-z0-9_.-]+', '_', artifact)
+        return os.path.join(self.root, 'manifests', name + '.json')
+
+    def is_fresh(self, artifact, key):
+        """
+        Whether `artifact` was last built with `key` and its outputs exist.
+        """
+        path = self._manifest(artifact)
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            manifest = json.load(f)
+        return (manifest['key'] == key and
+                all(os.path.exists(p) for p in manifest['outputs']))
+
+    def record(self, artifact, key, outputs):
+        write_json(self._manifest(artifact),
+                   {'key': key, 'outputs': [os.path.abspath(p) for p in outputs]})
+
+    def run(self, artifact, inputs, params, outputs, func):
+        """
+        Call `func()` to (re)build `artifact` unless it is up to date.
+        Returns True if `func` was run.
+        """
+        key = self.key(inputs, params)
+        if self.is_fresh(artifact, key):
+            return False
+        func()
+        self.record(artifact, key, outputs)
+        return True
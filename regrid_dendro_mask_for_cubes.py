@@ -1,33 +1,34 @@
 """
-Uses CASA's imregrid task to regrid dendrogram mask to MALT09 and APEX CMZ
-survey maps so that we can apply the masks later to analyse the spectral line
-data within the dendrogram leaves.
-"""
-from astropy.io import fits
-
-imregrid(imagename='./Masks/Final_continuum_clouds_mask.fits',
-         template='./APEX_data/APEX_13CO_2014_merge.im',
-         output='./Masks/Final_continuum_clouds_mask_regrid_to_APEX.im')
+Regrids the dendrogram leaf mask to the MALT90 and APEX CMZ survey maps so
+that we can apply the masks later to analyse the spectral line data within
+the dendrogram leaves. Runs in plain Python (see mask_regrid.py); no CASA
+session is needed.
 
-imregrid(imagename='./Masks/Final_continuum_clouds_mask.fits',
-         template='./MALT90_data/CMZ_3mm_HNCO.im',
-         output='./Masks/Final_continuum_clouds_mask_regrid_to_MALT90.im')
-
-exportfits(imagename='./Masks/Final_continuum_clouds_mask_regrid_to_APEX.im',
-           fitsimage='./Masks/Final_continuum_clouds_mask_regrid_to_APEX.fits')
+The regridded masks keep the leaf numbers (0 = no leaf) rather than a single
+0/1 mask; use `mask > 0` for the old behaviour.
+"""
+import os
+from leaf_set import load_leaf_set
+from mask_regrid import target_grid, regrid_labels, label_hdu
+# _____________________________________
 
-exportfits(imagename='./Masks/Final_continuum_clouds_mask_regrid_to_MALT90.im',
-           fitsimage='./Masks/Final_continuum_clouds_mask_regrid_to_MALT90.fits')
+# 'nearest' or 'exact' (fractional overlap; a pixel takes the leaf covering
+# at least `threshold` of it)
+method = 'nearest'
+threshold = 0.5
+cache_dir = './../Cache/regrid'
 
+templates = {'APEX': './APEX_data/APEX_13CO_2014_merge.fits',
+             'MALT90': './MALT90_data/CMZ_3mm_HNCO.fits'}
 
-data = fits.getdata('./Masks/Final_continuum_clouds_mask_regrid_to_APEX.fits')
-header = fits.getheader('./Masks/Final_continuum_clouds_mask_regrid_to_APEX.fits')
-data[data>0] = 1
-fits.writeto('./Masks/Final_continuum_clouds_mask_regrid_to_APEX_header_updated.fits',
-            data, header)
+if __name__ == "__main__":
+    index = load_leaf_set()
+    os.makedirs('./Masks', exist_ok=True)
 
-data = fits.getdata('./Masks/Final_continuum_clouds_mask_regrid_to_MALT90.fits')
-header = fits.getheader('./Masks/Final_continuum_clouds_mask_regrid_to_MALT90.fits')
-data[data>0] = 1
-fits.writeto('./Masks/Final_continuum_clouds_mask_regrid_to_MALT90_header_updated.fits',
-            data, header)
+    for name, template in templates.items():
+        target_wcs, shape_out = target_grid(template)
+        labels = regrid_labels(index, target_wcs, shape_out, method=method,
+                               threshold=threshold, cache_dir=cache_dir)
+        label_hdu(labels, target_wcs).writeto(
+            './Masks/Final_continuum_clouds_mask_regrid_to_'+name+'.fits',
+            overwrite=True)
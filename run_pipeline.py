@@ -0,0 +1,23 @@
+"""
+Runs the pipeline stages in order. Each stage keeps its artifacts in the
+content-hashed cache of pipeline_cache.py (under ./../Cache), so re-running
+after changing one molecule, cube or threshold only recomputes what depends
+on it.
+- extract_mean_leaf_spectra.py only runs when extract_leaf_cubes.py is set
+not to write the mean spectra itself; otherwise it would re-read the leaf
+cubes and overwrite the spectra the extraction just wrote.
+"""
+import sys
+import runpy
+from extract_leaf_cubes import write_spectra
+
+stages = (['Run_dendrogram_and_catalogue.py',
+           'extract_leaf_cubes.py'] +
+          ([] if write_spectra else ['extract_mean_leaf_spectra.py']) +
+          ['fit_leaf_spectra.py'])
+
+
+if __name__ == "__main__":
+    for stage in sys.argv[1:] or stages:
+        print('Running '+stage)
+        runpy.run_path(stage, run_name='__main__')
@@ -0,0 +1,365 @@
+"""
+Batch Gaussian fitting of the leaf mean spectra.
+- Collects every on-source and background-subtracted (on - inverted) mean
+spectrum written by the extraction stage, for all surveys and tracers, from
+each survey's spectrum store (see spectrum_store.py) when it has one and
+from the meanspec FITS files otherwise.
+- Derives the number of components and starting values of each fit from the
+spectrum itself (catalogue velocities only break ties between detected
+peaks), so fits can run unattended on any dendrogram.
+- Fits them across a pool of worker processes with pyspeckit, or all at once
+with the vectorised NumPy fitter in gaussian_fitter.py (backend='numpy').
+- Gathers the AMPLITUDE/SHIFT/WIDTH parameters, their errors, chi^2 and a
+convergence flag of every fit into one results table.
+Nothing is plotted here; see fit_HNCO.py for plotting fits from the table.
+"""
+import os
+import re
+import glob
+import numpy as np
+import pyspeckit
+from scipy import ndimage, signal
+from astropy import units as u
+from astropy.table import Table
+from concurrent.futures import ProcessPoolExecutor
+from leaf_cubes import leaf_spectrum_paths
+from spectrum_store import (SpectrumStore, channel_noise, open_store, read_spectrum,
+                            spectrum_store_path)
+from gaussian_fitter import fit_gaussians
+
+FWHM_FACTOR = np.sqrt(8*np.log(2))
+PARNAMES = ['AMPLITUDE', 'SHIFT', 'WIDTH']
+
+
+def spectrum_jobs(surveys, kinds=('on', 'bgsub')):
+    """
+    One job per (survey, molecule, leaf, kind) for every mean spectrum found
+    in the survey's meanspec/ directory. `kind` is 'on' for the on-source
+    spectrum and 'bgsub' for the on-source minus inverted spectrum. Jobs of
+    surveys with a spectrum store carry its path as 'store'.
+    """
+    jobs = []
+    for survey in surveys:
+        store_path = spectrum_store_path(survey)
+        if SpectrumStore.exists(store_path):
+            jobs += _store_jobs(survey, open_store(store_path), kinds)
+            continue
+        spec_dir = os.path.join(survey['out_dir'], 'meanspec')
+        for mol, cube_file in survey['lines']:
+            pattern = re.compile('^([0-9]+)_' + re.escape(mol) + '_cube_meanspec.fits$')
+            numbers = sorted(int(m.group(1)) for m in
+                             (pattern.match(os.path.basename(f))
+                              for f in glob.glob(os.path.join(spec_dir, '*.fits')))
+                             if m)
+            for number in numbers:
+                paths = leaf_spectrum_paths(survey, number, mol)
+                for kind in kinds:
+                    if kind == 'bgsub' and not os.path.exists(paths[1]):
+                        continue
+                    jobs.append({'survey': survey['name'], 'molecule': mol,
+                                 'leaf': number, 'kind': kind, 'paths': paths})
+    return jobs
+
+
+def _store_jobs(survey, store, kinds):
+    jobs = []
+    for mol, cube_file in survey['lines']:
+        if mol not in store.molecules:
+            continue
+        on = store.stack(molecule=mol, kind='on')
+        bg = store.stack(molecule=mol, kind='bg')
+        for row, number in enumerate(store.leaves):
+            if not np.isfinite(on[row]).any():
+                continue
+            for kind in kinds:
+                if kind == 'bgsub' and not np.isfinite(bg[row]).any():
+                    continue
+                jobs.append({'survey': survey['name'], 'molecule': mol,
+                             'leaf': number, 'kind': kind, 'store': store.path,
+                             'paths': leaf_spectrum_paths(survey, number, mol)})
+    return jobs
+
+
+def job_inputs(job):
+    """Files the spectrum of a job is read from."""
+    return open_store(job['store']).files if 'store' in job else list(job['paths'])
+
+
+def load_spectrum(job):
+    """
+    The spectrum of a job as a pyspeckit.Spectrum in km/s, with its error set
+    to a robust estimate of the channel noise.
+    """
+    if 'store' in job:
+        velocity, data = job_spectrum(job)
+        sp = pyspeckit.Spectrum(data=data, unit=open_store(job['store']).unit,
+                                xarr=pyspeckit.units.SpectroscopicAxis(velocity,
+                                                                       unit='km/s'))
+    else:
+        sp = pyspeckit.Spectrum(job['paths'][0])
+        if job['kind'] == 'bgsub':
+            sp = sp - pyspeckit.Spectrum(job['paths'][1])
+        sp.xarr.convert_to_unit(u.km/u.s)
+    sp.error[:] = job_noise(job, sp.data)
+    return sp
+
+
+def job_spectrum(job):
+    """
+    Velocity axis (km/s) and values of the spectrum of a job, without going
+    through pyspeckit.
+    """
+    if 'store' in job:
+        store = open_store(job['store'])
+        return (store.molecule_velocity(job['molecule']),
+                store.spectrum(job['leaf'], job['molecule'], job['kind']))
+    velocity, data = read_spectrum(job['paths'][0])
+    if job['kind'] == 'bgsub':
+        data = data - read_spectrum(job['paths'][1])[1]
+    return velocity, data
+
+
+def job_noise(job, data):
+    """
+    Channel noise of the spectrum of a job: as kept in its spectrum store
+    (propagated from the on-source and background noise for 'bgsub'), or
+    estimated from `data` otherwise.
+    """
+    if 'store' in job:
+        noise = open_store(job['store']).spectrum_noise(job['leaf'], job['molecule'],
+                                                        job['kind'])
+        if noise is not None:
+            return noise
+    return channel_noise(data)
+
+
+def gaussian_model(x, params):
+    """
+    Sum of Gaussians with flat [amp, shift, width, amp, ...] parameters.
+    """
+    params = np.asarray(params, dtype=float).reshape(-1, 3)
+    return sum(amp * np.exp(-(x - shift)**2 / (2 * width**2))
+               for amp, shift, width in params)
+
+
+def guesses_from_priors(x, data, priors):
+    """
+    Flat pyspeckit guesses from (amplitude, v_cen, width) priors. Amplitudes
+    given as None are read off the spectrum at v_cen.
+    """
+    guesses = []
+    for amp, v_cen, width in priors:
+        if amp is None:
+            amp = np.nanmax([data[np.argmin(np.abs(x - float(v_cen)))],
+                             channel_noise(data)])
+        guesses += [float(amp), float(v_cen), float(width)]
+    return guesses
+
+
+def auto_priors(x, data, max_components=2, v_prior=None, width_prior=None,
+                snr=5., smooth=1.5):
+    """
+    Number of components and (amplitude, v_cen, width) starting values for a
+    spectrum, so that no hand-tuned guesses are needed.
+
+    Components are the most prominent peaks of the spectrum (smoothed by a
+    Gaussian of `smooth` channels) rising at least `snr` times the channel
+    noise above their surroundings, with widths from the peak FWHM. The
+    number of components is always set by the detected peaks. Catalogue
+    velocities (`v_prior`, a list) only break ties: when more than
+    `max_components` peaks are found, those within their FWHM of a catalogue
+    velocity are kept first. A catalogue dispersion (`width_prior`) replaces
+    the measured widths. If nothing is detected, a single component is
+    placed at the intensity-weighted mean velocity of the positive channels.
+    """
+    data = np.asarray(data, dtype=float)
+    finite = np.isfinite(data)
+    filled = np.where(finite, data, 0.)
+    dv = np.abs(np.median(np.diff(x)))
+    noise = channel_noise(data)
+    smoothed = ndimage.gaussian_filter1d(filled, smooth) if smooth else filled
+
+    peaks, props = signal.find_peaks(smoothed, prominence=snr * noise / np.sqrt(1 + smooth))
+    widths = (signal.peak_widths(smoothed, peaks, rel_height=0.5)[0] * dv / FWHM_FACTOR
+              if len(peaks) else np.array([]))
+    order = np.argsort(props['prominences'])[::-1]
+    if v_prior is not None and len(v_prior) and len(peaks) > max_components:
+        offsets = np.abs(x[peaks][:, None] - np.asarray(v_prior, dtype=float)[None, :])
+        matched = offsets.min(axis=1) <= widths * FWHM_FACTOR
+        order = np.lexsort((-props['prominences'], ~matched))
+    keep = np.sort(order[:max_components])
+    peaks, widths = peaks[keep], widths[keep]
+
+    if len(peaks):
+        v_cens = x[peaks]
+    else:
+        positive = np.clip(filled, 0, None)
+        v_cens = np.array([np.sum(x * positive) / np.sum(positive)
+                           if positive.sum() > 0 else x[np.argmax(filled)]])
+
+    priors = []
+    for v_cen in v_cens:
+        channel = np.argmin(np.abs(x - v_cen))
+        amp = max(smoothed[channel], noise)
+        if width_prior is not None and np.isfinite(width_prior):
+            width = float(width_prior)
+        elif len(peaks):
+            width = widths[np.argmin(np.abs(x[peaks] - v_cen))]
+        else:
+            width = 10. * dv
+        priors.append((amp, float(v_cen), max(width, dv)))
+    return priors
+
+
+def job_priors(job, x, data, max_components=2):
+    """
+    The job's own 'priors' if it has them, else automatic ones, using the
+    optional catalogue 'v_prior' and 'width_prior' entries of the job.
+    """
+    if job.get('priors'):
+        return job['priors']
+    return auto_priors(x, data, max_components=max_components,
+                       v_prior=job.get('v_prior'),
+                       width_prior=job.get('width_prior'))
+
+
+def _empty_row(job, max_components, ncomp=0):
+    row = {'survey': job['survey'], 'molecule': job['molecule'],
+           'leaf': job['leaf'], 'kind': job['kind'],
+           'ncomp': ncomp, 'chi2': np.nan, 'dof': np.nan,
+           'redchi2': np.nan, 'status': 0, 'converged': False, 'error': ''}
+    for i in range(max_components):
+        for name in PARNAMES + ['FWHM']:
+            row[name+str(i)] = np.nan
+            row[name+str(i)+'_err'] = np.nan
+    return row
+
+
+def _error_row(job, max_components, exc):
+    """Row of a job that raised `exc`, with the exception in 'error'."""
+    row = _empty_row(job, max_components)
+    row['error'] = '{0}: {1}'.format(type(exc).__name__, exc)
+    return row
+
+
+def fit_spectrum(job, max_components=2):
+    """
+    Fit one spectrum with pyspeckit and return its row of the results table.
+    A job that raises (unreadable spectrum, bad priors, pyspeckit error)
+    gives an unfitted row with the exception in its 'error' column, so one
+    bad job does not abort the batch but is not mistaken for a failed fit.
+    """
+    row = _empty_row(job, max_components)
+
+    try:
+        sp = load_spectrum(job)
+        priors = job_priors(job, sp.xarr.value, sp.data, max_components)
+        guesses = guesses_from_priors(sp.xarr.value, sp.data, priors)
+        sp.specfit(fittype='gaussian', Interactive=False, annotate=False,
+                   guesses=guesses)
+        parinfo = sp.specfit.parinfo
+        status = sp.specfit.fitter.mp.status
+    except Exception as exc:
+        return _error_row(job, max_components, exc)
+    row['ncomp'] = len(priors)
+
+    # A failed mpfit fit (e.g. on a noise-only spectrum) has no errors.
+    failed = any(par.error is None for par in parinfo)
+    for par in parinfo:
+        row[par.parname] = par.value
+        row[par.parname+'_err'] = np.nan if par.error is None else par.error
+    for i in range(row['ncomp']):
+        row['FWHM'+str(i)] = row['WIDTH'+str(i)] * FWHM_FACTOR
+        row['FWHM'+str(i)+'_err'] = row['WIDTH'+str(i)+'_err'] * FWHM_FACTOR
+    row['chi2'] = sp.specfit.chi2
+    row['dof'] = sp.specfit.dof
+    row['redchi2'] = sp.specfit.chi2 / sp.specfit.dof if sp.specfit.dof > 0 else np.nan
+    row['status'] = status
+    # mpfit status 1-4 means one of its convergence criteria was met.
+    row['converged'] = bool(1 <= status <= 4) and not failed
+    return row
+
+
+def _fit_job(args):
+    job, max_components = args
+    return fit_spectrum(job, max_components=max_components)
+
+
+def fit_spectra_numpy(jobs, max_components=2, **kwargs):
+    """
+    Fit jobs with the vectorised NumPy fitter. Spectra sharing a velocity
+    axis and component count are stacked and fitted in one call. The
+    'status' column holds the number of iterations. Jobs whose spectrum or
+    priors cannot be obtained get an 'error' row, as in `fit_spectrum`.
+    """
+    rows = []
+    groups = {}
+    for n, job in enumerate(jobs):
+        try:
+            velocity, data = job_spectrum(job)
+            priors = job_priors(job, velocity, data, max_components)
+            guesses = guesses_from_priors(velocity, data, priors)
+            noise = job_noise(job, data)
+        except Exception as exc:
+            rows.append(_error_row(job, max_components, exc))
+            continue
+        rows.append(_empty_row(job, max_components, ncomp=len(priors)))
+        key = (len(priors), velocity.size, velocity[0], velocity[-1])
+        groups.setdefault(key, []).append((n, velocity, data, guesses, noise))
+
+    for (ncomp, nchan, v0, v1), members in groups.items():
+        velocity = members[0][1]
+        spectra = np.array([data for n, v, data, guess, noise in members])
+        guesses = [guess for n, v, data, guess, noise in members]
+        errors = np.array([noise for n, v, data, guess, noise in members])
+        result = fit_gaussians(velocity, spectra, guesses, errors=errors, **kwargs)
+
+        for k, (n, v, data, guess, noise) in enumerate(members):
+            row = rows[n]
+            for i in range(ncomp):
+                for j, name in enumerate(PARNAMES):
+                    row[name+str(i)] = result['params'][k, 3*i+j]
+                    row[name+str(i)+'_err'] = result['errors'][k, 3*i+j]
+                row['FWHM'+str(i)] = row['WIDTH'+str(i)] * FWHM_FACTOR
+                row['FWHM'+str(i)+'_err'] = row['WIDTH'+str(i)+'_err'] * FWHM_FACTOR
+            row['chi2'] = result['chi2'][k]
+            row['dof'] = result['dof'][k]
+            row['redchi2'] = row['chi2'] / row['dof'] if row['dof'] > 0 else np.nan
+            row['status'] = result['niter'][k]
+            row['converged'] = bool(result['converged'][k])
+    return rows
+
+
+def fit_spectra(jobs, n_workers=1, max_components=2, backend='pyspeckit'):
+    """
+    Fit every job and return the results table. Jobs without a 'priors'
+    entry get automatic starting values (see `auto_priors`). With
+    backend='pyspeckit' the fits are spread over `n_workers` processes;
+    backend='numpy' fits them all at once with gaussian_fitter. Jobs that
+    raised have their exception in the 'error' column (empty otherwise).
+    """
+    args = [(job, max_components) for job in jobs]
+    if backend == 'numpy':
+        rows = fit_spectra_numpy(jobs, max_components=max_components)
+    elif n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            rows = list(executor.map(_fit_job, args,
+                                     chunksize=max(1, len(args) // (4 * n_workers))))
+    else:
+        rows = [_fit_job(a) for a in args]
+
+    names = ['survey', 'molecule', 'leaf', 'kind', 'ncomp']
+    for i in range(max_components):
+        for name in PARNAMES + ['FWHM']:
+            names += [name+str(i), name+str(i)+'_err']
+    names += ['chi2', 'dof', 'redchi2', 'status', 'converged', 'error']
+    if not rows:
+        return Table(names=names)
+    return Table(rows=[[row[n] for n in names] for row in rows], names=names)
+
+
+def fitted_params(row):
+    """
+    Flat [amp, shift, width, ...] parameters of a results table row.
+    """
+    return [row[name+str(i)] for i in range(row['ncomp']) for name in PARNAMES]
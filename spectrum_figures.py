@@ -0,0 +1,184 @@
+"""
+Multi-panel spectrum figures of every leaf, one panel per tracer, showing
+the on-source and background-subtracted mean spectra.
+- The panels (survey, molecule, label and velocity range of each) come from
+a layout config rather than one hand-written block per tracer.
+- The figure, its axes, labels and lines are built once per process; for
+each leaf only the line data (`Line2D.set_data`) and the y-limits change
+before it is saved.
+- Spectra are read from the spectrum stores (see spectrum_store.py), and
+leaves are rendered across a pool of worker processes.
+- Output is one PDF or PNG per leaf, a single multi-page PDF, or PNG atlas
+pages holding the figures of several leaves each.
+"""
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.image import imsave
+from spectrum_store import SpectrumStore, open_store
+
+
+def figure_template(panels, layout=(3, 2), figsize=(6.4, 4.8), fontsize=8):
+    """
+    Empty figure with one axes per panel, laid out on a `layout` (rows,
+    columns) grid. Returns the figure and, per panel, (axes, on-source line,
+    background-subtracted line).
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    nrows, ncols = layout
+    lines = []
+    for k, panel in enumerate(panels):
+        ax = fig.add_subplot(nrows, ncols, k+1)
+        bgsub_line, = ax.plot([], [], color='k', linestyle='--', drawstyle='steps-mid')
+        on_line, = ax.plot([], [], color='k', drawstyle='steps-mid')
+        ax.text(0.02, 0.95, panel['label'],
+                verticalalignment='top', horizontalalignment='left',
+                transform=ax.transAxes, color='black', fontsize=fontsize)
+        if panel.get('legend'):
+            ax.annotate("-  Data", xy=(0.77, 0.92), xycoords='axes fraction', size=6)
+            ax.annotate("-- Data - BG", xy=(0.77, 0.84), xycoords='axes fraction', size=6)
+        ax.set_xlim(*panel.get('xlim', (-200, 200)))
+        ax.tick_params(labelsize=fontsize)
+        # Only the bottom row keeps its velocity axis.
+        if k < len(panels) - ncols:
+            ax.xaxis.set_visible(False)
+        lines.append((ax, on_line, bgsub_line))
+    fig.text(0.5, 0.02, 'Velocity (km/s)', ha='center', fontsize=10)
+    fig.text(0.04, 0.5, 'Brightness Temperature (K)', va='center',
+             rotation='vertical', fontsize=10)
+    return fig, lines
+
+
+def leaf_spectra(stores, panels, number):
+    """
+    (velocity, on, bgsub) of every panel for leaf `number`, from the
+    spectrum stores (survey name -> store directory); None for panels whose
+    survey or molecule has no spectrum of that leaf.
+    """
+    data = []
+    for panel in panels:
+        store = (open_store(stores[panel['survey']])
+                 if panel['survey'] in stores else None)
+        if store is None or (number, panel['molecule']) not in store:
+            data.append(None)
+            continue
+        data.append((store.molecule_velocity(panel['molecule']),
+                     store.spectrum(number, panel['molecule'], 'on'),
+                     store.spectrum(number, panel['molecule'], 'bgsub')))
+    return data
+
+
+def update_figure(lines, data):
+    """Put one leaf's spectra into the template lines and rescale the y-axes."""
+    for (ax, on_line, bgsub_line), spectra in zip(lines, data):
+        if spectra is None:
+            on_line.set_data([], [])
+            bgsub_line.set_data([], [])
+        else:
+            velocity, on, bgsub = spectra
+            on_line.set_data(velocity, on)
+            bgsub_line.set_data(velocity, bgsub)
+        ax.relim()
+        ax.autoscale_view(scalex=False)
+
+
+# Per-process state, set by `_init_worker`.
+_template = {}
+
+
+def _init_worker(stores, panels, layout, figsize):
+    fig, lines = figure_template(panels, layout=layout, figsize=figsize)
+    _template.update(stores=stores, panels=panels, fig=fig, lines=lines)
+
+
+def _render_leaf(args):
+    """
+    Draw leaf `number` on this process's template and save it to `path`, or
+    return it as an RGBA image array if `path` is None.
+    """
+    number, path, dpi = args
+    update_figure(_template['lines'],
+                  leaf_spectra(_template['stores'], _template['panels'], number))
+    fig = _template['fig']
+    if path is not None:
+        fig.savefig(path, dpi=dpi)
+        return path
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba()).copy()
+
+
+def _atlas_pages(images, shape):
+    """Tile equally sized RGBA images onto pages of shape (rows, columns)."""
+    nrows, ncols = shape
+    height, width = images[0].shape[:2]
+    for start in range(0, len(images), nrows * ncols):
+        page = np.full((nrows * height, ncols * width, 4), 255, dtype=np.uint8)
+        for k, image in enumerate(images[start:start + nrows * ncols]):
+            row, col = divmod(k, ncols)
+            page[row*height:(row+1)*height, col*width:(col+1)*width] = image
+        yield page
+
+
+def render_leaf_figures(stores, panels, leaves, out_dir, output='pdf',
+                        layout=(3, 2), figsize=(6.4, 4.8), name='multispec',
+                        n_workers=1, dpi=100, atlas_shape=(4, 4)):
+    """
+    Render the figure of every leaf in `leaves` and return the files written.
+
+    output='pdf' or 'png' writes <out_dir>/<leaf>_<name>.pdf/.png, one per
+    leaf; output='atlas' writes PNG pages <name>_atlas_<k>.png with
+    `atlas_shape` (rows, columns) leaf figures each. Both render across
+    `n_workers` processes. output='multipage' writes every leaf as a page of
+    a single <name>.pdf, from one process since the pages go to one file.
+    Raises FileNotFoundError if a store the panels need has not been built.
+    """
+    missing = sorted(set(stores[panel['survey']] for panel in panels
+                         if panel['survey'] in stores and
+                         not SpectrumStore.exists(stores[panel['survey']])))
+    if missing:
+        raise FileNotFoundError("No spectrum store at {0}: run "
+                                "build_spectrum_stores.py first".format(', '.join(missing)))
+    os.makedirs(out_dir, exist_ok=True)
+    initargs = (stores, panels, layout, figsize)
+
+    if output == 'multipage':
+        _init_worker(*initargs)
+        path = os.path.join(out_dir, name+'.pdf')
+        with PdfPages(path) as pdf:
+            for number in leaves:
+                update_figure(_template['lines'],
+                              leaf_spectra(stores, panels, number))
+                pdf.savefig(_template['fig'])
+        return [path]
+
+    if output in ('pdf', 'png'):
+        tasks = [(number, os.path.join(out_dir, '{0}_{1}.{2}'.format(number, name, output)),
+                  dpi) for number in leaves]
+    elif output == 'atlas':
+        tasks = [(number, None, dpi) for number in leaves]
+    else:
+        raise ValueError("output must be 'pdf', 'png', 'multipage' or 'atlas'")
+
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tasks)),
+                                 initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            results = list(executor.map(_render_leaf, tasks,
+                                        chunksize=max(1, len(tasks) // (4 * n_workers))))
+    else:
+        _init_worker(*initargs)
+        results = [_render_leaf(task) for task in tasks]
+
+    if output != 'atlas':
+        return results
+    written = []
+    for k, page in enumerate(_atlas_pages(results, atlas_shape)):
+        path = os.path.join(out_dir, '{0}_atlas_{1}.png'.format(name, k+1))
+        imsave(path, page)
+        written.append(path)
+    return written
@@ -0,0 +1,238 @@
+"""
+One file for all the leaf mean spectra of a survey, instead of one small
+meanspec FITS file per leaf, molecule and on-source/background spectrum.
+- The spectra are stacked in a single array of shape (leaf, molecule, kind,
+channel), kind being 'on' (on-source), 'bg' (background) or 'bgsub',
+saved as a .npy file that readers memory-map.
+- Each molecule keeps its own velocity axis (km/s). When all molecules share
+one, velocity.npy holds it; otherwise it holds one row per molecule, and
+spectra and axes shorter than the longest are padded with NaN. Given an
+explicit axis, all spectra are instead linearly interpolated onto it (with
+NaN outside their own velocity range), and the molecules that had to be
+resampled are listed as 'resampled' in index.json.
+- The background-subtracted spectra (on - bg) of every leaf, survey and
+molecule are computed once, as one array operation when the store is
+written, and kept as a third kind 'bgsub'. The channel noise of every
+spectrum is kept alongside (noise.npy, shape (leaf, molecule, kind)). It is
+measured on the native channels, before any resampling (which correlates
+neighbouring channels and would lower it), and that of 'bgsub' is
+propagated from the on-source and background noise.
+- An index.json next to it lists the leaves, molecules and kinds along the
+axes, so a spectrum is found by key without parsing any FITS header.
+"""
+import os
+import json
+import numpy as np
+from astropy import wcs
+from astropy import units as u
+from astropy.io import fits
+from astropy.stats import mad_std
+from pipeline_cache import save_atomic, write_json
+
+KINDS = ('on', 'bg', 'bgsub')
+
+
+def spectrum_store_path(survey):
+    """Spectrum store directory of a survey of extract_leaf_cubes.py."""
+    return os.path.join(survey['out_dir'], survey.get('store_dir', 'spectra'))
+
+
+def wcs_velocity(spec_wcs, nchan):
+    """Velocity (km/s) of each channel of a 1-D spectral WCS."""
+    return (spec_wcs.pixel_to_world_values(np.arange(nchan)) *
+            u.Unit(spec_wcs.wcs.cunit[0])).to(u.km/u.s).value
+
+
+def cube_velocity(cube_file):
+    """Velocity axis (km/s) of a cube, from its header only."""
+    header = fits.getheader(cube_file)
+    return wcs_velocity(wcs.WCS(header).sub([wcs.WCSSUB_SPECTRAL]), header['NAXIS3'])
+
+
+def read_spectrum(path):
+    """
+    Velocity axis (km/s) and values of a 1-D mean spectrum FITS file.
+    """
+    data, header = fits.getdata(path, header=True)
+    return wcs_velocity(wcs.WCS(header), data.size), data.astype(float)
+
+
+def interpolate_spectrum(velocity, values, target):
+    """`values` on the `velocity` axis, resampled onto the `target` axis."""
+    if velocity.size == target.size and np.allclose(velocity, target):
+        return np.asarray(values, dtype=float)
+    order = np.argsort(velocity)
+    return np.interp(target, velocity[order], np.asarray(values, dtype=float)[order],
+                     left=np.nan, right=np.nan)
+
+
+def channel_noise(spectra):
+    """
+    Channel-to-channel rms noise of a spectrum, or of each spectrum along the
+    last axis, from the MAD of the first differences so that line emission
+    barely affects it. NaN channels are ignored.
+    """
+    with np.errstate(invalid='ignore'):
+        return mad_std(np.diff(spectra, axis=-1), axis=-1, ignore_nan=True) / np.sqrt(2)
+
+
+def subtract_background(data, noise):
+    """
+    Fill the 'bgsub' spectra of a (leaf, molecule, kind, channel) stack
+    with on - bg, and their noise in `noise`, shape (leaf, molecule, kind),
+    propagated from the on-source and background noise.
+    """
+    on, bg, bgsub = (KINDS.index(kind) for kind in ('on', 'bg', 'bgsub'))
+    data[:, :, bgsub] = data[:, :, on] - data[:, :, bg]
+    noise[:, :, bgsub] = np.hypot(noise[:, :, on], noise[:, :, bg])
+    return noise
+
+
+def same_axis(velocity, target):
+    """Whether two velocity axes have the same channels."""
+    return velocity.size == target.size and np.allclose(velocity, target)
+
+
+def write_spectrum_store(path, spectra, molecules=None, velocity=None, unit='K'):
+    """
+    Write a spectrum store to the directory `path`.
+
+    `spectra` maps (leaf, molecule) -> (velocity, on, bg), with `bg` None
+    when there is no background spectrum. `molecules` sets the order of the
+    molecule axis (default: order of first appearance). Each molecule keeps
+    the axis of its first spectrum, unless `velocity` gives one axis to
+    resample every spectrum onto.
+    """
+    os.makedirs(path, exist_ok=True)
+    leaves = sorted(set(int(leaf) for leaf, mol in spectra))
+    if molecules is None:
+        molecules = []
+        for leaf, mol in spectra:
+            if mol not in molecules:
+                molecules.append(mol)
+    molecules = [mol for mol in molecules
+                 if any((leaf, mol) in spectra for leaf in leaves)]
+    if velocity is not None:
+        axes = [np.asarray(velocity, dtype=float)] * len(molecules)
+    else:
+        axes = [np.asarray(next(spectra[key][0] for key in spectra if key[1] == mol),
+                           dtype=float) for mol in molecules]
+    nchan = max(axis.size for axis in axes) if axes else 0
+
+    data = np.full((len(leaves), len(molecules), len(KINDS), nchan), np.nan)
+    noise = np.full(data.shape[:3], np.nan)
+    resampled = set()
+    for (leaf, mol), (spec_velocity, on, bg) in spectra.items():
+        i, j = leaves.index(int(leaf)), molecules.index(mol)
+        spec_velocity, axis = np.asarray(spec_velocity, dtype=float), axes[j]
+        if not same_axis(spec_velocity, axis):
+            resampled.add(mol)
+        for kind, values in (('on', on), ('bg', bg)):
+            if values is not None:
+                k = KINDS.index(kind)
+                noise[i, j, k] = channel_noise(np.asarray(values, dtype=float))
+                data[i, j, k, :axis.size] = interpolate_spectrum(spec_velocity, values, axis)
+    subtract_background(data, noise)
+
+    if velocity is not None or all(same_axis(axis, axes[0]) for axis in axes):
+        velocity = axes[0] if axes else np.zeros(0)
+    else:
+        velocity = np.full((len(molecules), nchan), np.nan)
+        for j, axis in enumerate(axes):
+            velocity[j, :axis.size] = axis
+
+    save_atomic(os.path.join(path, 'spectra.npy'), np.save, data)
+    save_atomic(os.path.join(path, 'noise.npy'), np.save, noise)
+    save_atomic(os.path.join(path, 'velocity.npy'), np.save, velocity)
+    index = {'leaves': leaves, 'molecules': molecules, 'kinds': list(KINDS),
+             'unit': str(unit), 'velocity_unit': 'km/s',
+             'resampled': [mol for mol in molecules if mol in resampled]}
+    # Written last, so readers never see an index that does not match the data.
+    write_json(os.path.join(path, 'index.json'), index)
+
+
+class SpectrumStore(object):
+    """
+    Read access to a spectrum store. `data` is the memory-mapped array of
+    shape (leaf, molecule, kind, channel), `noise` the channel noise of each
+    spectrum, shape (leaf, molecule, kind), and `velocity` the shared axis,
+    or one NaN-padded row per molecule (see `molecule_velocity`).
+    `resampled` lists the molecules interpolated onto another axis.
+    Stores written before 'bgsub' and `noise` were kept give on - bg and
+    None instead.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.leaves = index['leaves']
+        self.molecules = index['molecules']
+        self.kinds = index['kinds']
+        self.unit = index['unit']
+        self.resampled = index.get('resampled', [])
+        self.velocity = np.load(os.path.join(path, 'velocity.npy'))
+        self.data = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r')
+        self.noise = (np.load(os.path.join(path, 'noise.npy'))
+                      if 'bgsub' in self.kinds else None)
+        self._leaf_rows = dict((leaf, i) for i, leaf in enumerate(self.leaves))
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'index.json'))
+
+    @property
+    def files(self):
+        """Files making up the store, e.g. as cache inputs."""
+        names = ['index.json', 'velocity.npy', 'spectra.npy']
+        if self.noise is not None:
+            names.append('noise.npy')
+        return [os.path.join(self.path, name) for name in names]
+
+    def __contains__(self, key):
+        leaf, molecule = key[:2]
+        return leaf in self._leaf_rows and molecule in self.molecules
+
+    def molecule_velocity(self, molecule):
+        """Velocity axis (km/s) of the spectra of `molecule`."""
+        if self.velocity.ndim == 1:
+            return self.velocity
+        axis = self.velocity[self.molecules.index(molecule)]
+        return axis[np.isfinite(axis)]
+
+    def spectrum(self, leaf, molecule, kind='on'):
+        """Values of one spectrum on the velocity axis of its molecule."""
+        if kind not in self.kinds and kind == 'bgsub':
+            return self.spectrum(leaf, molecule, 'on') - self.spectrum(leaf, molecule, 'bg')
+        return np.array(self.data[self._leaf_rows[leaf], self.molecules.index(molecule),
+                                  self.kinds.index(kind), :self.molecule_velocity(molecule).size])
+
+    def spectrum_noise(self, leaf, molecule, kind='on'):
+        """Channel noise of one spectrum (None if the store has none)."""
+        if self.noise is None:
+            return None
+        return float(self.noise[self._leaf_rows[leaf], self.molecules.index(molecule),
+                                self.kinds.index(kind)])
+
+    def stack(self, molecule=None, kind=None):
+        """
+        Stacked spectra, optionally restricted to one molecule and/or kind
+        (which drops that axis), NaN-padded past each molecule's channels.
+        """
+        key = (slice(None),
+               slice(None) if molecule is None else self.molecules.index(molecule),
+               slice(None) if kind is None else self.kinds.index(kind))
+        return np.asarray(self.data[key])
+
+
+# Stores opened by this process, so worker processes memory-map each store
+# once rather than once per spectrum. Keyed by the time the store was last
+# written, so a rewritten store is opened again.
+_open_stores = {}
+
+
+def open_store(path):
+    key = (path, os.path.getmtime(os.path.join(path, 'index.json')))
+    if key not in _open_stores:
+        _open_stores[key] = SpectrumStore(path)
+    return _open_stores[key]
@@ -0,0 +1,54 @@
+"""
+Background regions of background_regions.py, checked pixel by pixel.
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from leaf_index import LeafIndex
+from background_regions import INVERTED, background_regions
+
+
+def two_leaves():
+    labels = np.zeros((40, 40), dtype=np.int32)
+    labels[10:18, 8:20] = 1
+    labels[14:24, 21:26] = 2
+    return LeafIndex(labels, [1, 2], [0, 1])
+
+
+def full_mask(index, view, mask):
+    full = np.zeros(index.shape, dtype=bool)
+    full[view] = mask
+    return full
+
+
+def test_box_is_bounding_box_minus_leaf():
+    index = two_leaves()
+    for number, view, mask in background_regions(index, **INVERTED):
+        assert view == index.views[number]
+        assert np.array_equal(mask, index.labels[view] != number)
+
+
+def test_shell_distance_and_exclusion():
+    index = two_leaves()
+    yy, xx = np.indices(index.shape)
+    for number, view, mask in background_regions(index, kind='shell', width=3, gap=1):
+        y, x = index.indices(number)
+        # Brute-force distance of every pixel to the nearest leaf pixel.
+        dist = np.min(np.hypot(yy[..., None] - y, xx[..., None] - x), axis=-1)
+        expected = (dist > 1) & (dist <= 4) & (index.labels == 0)
+        assert np.array_equal(full_mask(index, view, mask), expected)
+
+
+def test_annulus_radius():
+    index = two_leaves()
+    yy, xx = np.indices(index.shape)
+    for number, view, mask in background_regions(index, kind='annulus', width=2,
+                                                 gap=1, exclude_leaves=False):
+        y, x = index.indices(number)
+        r = np.hypot(yy - y.mean(), xx - x.mean())
+        r_in = np.sqrt(len(y) / np.pi) + 1
+        expected = (r > r_in) & (r <= r_in + 2) & (index.labels != number)
+        assert np.array_equal(full_mask(index, view, mask), expected)
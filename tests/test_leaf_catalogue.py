@@ -0,0 +1,74 @@
+"""
+batch_pp_statistics (leaf_catalogue.py) against MyPPStatistic evaluated leaf
+by leaf, and the leaf statistics of leaf_stats.py against NumPy.
+"""
+import os
+import sys
+import numpy as np
+from astropy import units as u
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from leaf_index import LeafIndex
+from leaf_catalogue import FIELDS, MyPPStatistic, leaf_catalogue
+from leaf_stats import grouped_statistics, leaf_map_statistics
+
+
+def leaf_map(seed=0):
+    """Random column density map with three leaves, one holding a NaN."""
+    rng = np.random.RandomState(seed)
+    data = rng.lognormal(mean=50., sigma=0.5, size=(40, 50))
+    labels = np.zeros(data.shape, dtype=np.int32)
+    labels[5:15, 4:20] = 1
+    labels[20:34, 25:31] = 2
+    labels[30:38, 5:12] = 3
+    labels[8:12, 30:45] = 3
+    data[7, 8] = np.nan
+    return data, LeafIndex(labels, [1, 2, 3], [10, 11, 12])
+
+
+metadata = {'data_unit': u.cm**-2, 'spatial_scale': 0.002 * u.deg,
+            'beam_major': 36 * u.arcsec, 'beam_minor': 36 * u.arcsec,
+            'distance': 8.1 * u.kpc, 'particle_mass': 2.8 * u.Da}
+
+
+def test_batch_catalogue_matches_per_leaf_statistic():
+    data, index = leaf_map()
+    batch = leaf_catalogue(index, data, metadata)
+    per_leaf = leaf_catalogue(index, data, metadata, statistic=MyPPStatistic)
+    for field in FIELDS:
+        assert batch[field].unit == per_leaf[field].unit, field
+        assert np.allclose(batch[field], per_leaf[field], rtol=1e-10,
+                           equal_nan=True), field
+
+
+def test_grouped_statistics_match_numpy():
+    rng = np.random.RandomState(1)
+    groups = [rng.normal(size=n) for n in (5, 1, 12, 3)]
+    groups[2][[0, 4]] = np.nan
+    groups[3][:] = np.nan
+    values = np.concatenate(groups + [np.zeros(0)])
+    offsets = np.concatenate([[0], np.cumsum([g.size for g in groups] + [0])])
+    stats = grouped_statistics(values, offsets, percentiles=(16, 84))
+    for i, g in enumerate(groups):
+        if np.isfinite(g).any():
+            assert stats['peak'][i] == np.nanmax(g)
+            assert np.isclose(stats['mean'][i], np.nanmean(g))
+            assert np.isclose(stats['median'][i], np.nanmedian(g))
+            assert np.isclose(stats['p16'][i], np.nanpercentile(g, 16))
+            assert np.isclose(stats['p84'][i], np.nanpercentile(g, 84))
+        else:
+            assert np.isnan(stats['peak'][i]) and np.isnan(stats['median'][i])
+    assert list(stats['nfinite']) == [5, 1, 10, 0, 0]
+    assert np.isnan(stats['mean'][4])
+
+
+def test_leaf_map_statistics_match_masks():
+    data, index = leaf_map()
+    table = leaf_map_statistics(index, data, 'col')
+    for row, number in zip(table, index.numbers):
+        values = data[index.labels == number]
+        assert row['_idx'] == number
+        assert row['peak_col'] == np.nanmax(values)
+        assert np.isclose(row['median_col'], np.nanmedian(values))
+        assert row['nnan_col'] == np.isnan(values).sum()
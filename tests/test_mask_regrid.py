@@ -0,0 +1,49 @@
+"""
+Leaf label regridding and coverage of mask_regrid.py on simple grids.
+"""
+import os
+import sys
+import numpy as np
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from leaf_index import LeafIndex
+from mask_regrid import leaf_coverage, regrid_labels
+
+
+def grid(shape, cdelt):
+    w = WCS(naxis=2)
+    w.wcs.ctype = ['GLON-CAR', 'GLAT-CAR']
+    w.wcs.cdelt = [-cdelt, cdelt]
+    w.wcs.crval = [0., 0.]
+    w.wcs.crpix = [(shape[1] + 1) / 2., (shape[0] + 1) / 2.]
+    return w
+
+
+def leaf_index():
+    labels = np.zeros((24, 24), dtype=np.int32)
+    labels[4:10, 4:12] = 1
+    labels[14:20, 10:22] = 2
+    return LeafIndex(labels, [1, 2], [0, 1], header=grid(labels.shape, 0.01).to_header())
+
+
+def test_same_grid_keeps_labels():
+    index = leaf_index()
+    for method in ('nearest', 'exact'):
+        labels = regrid_labels(index, index.wcs, index.shape, method=method)
+        assert np.array_equal(labels, index.labels), method
+
+
+def test_coverage_conserves_area(tmp_path):
+    index = leaf_index()
+    coarse = grid((12, 12), 0.02)
+    coverage = leaf_coverage(index, coarse, (12, 12), cache_dir=str(tmp_path))
+    assert [n for n, v, f in coverage] == [1, 2]
+    npix = dict((n, (index.labels == n).sum()) for n in index.numbers)
+    for number, view, fraction in coverage:
+        # One coarse pixel covers four fine pixels.
+        assert np.isclose(fraction.sum() * 4, npix[number], rtol=1e-3)
+    cached = leaf_coverage(index, coarse, (12, 12), cache_dir=str(tmp_path))
+    for (n1, v1, f1), (n2, v2, f2) in zip(coverage, cached):
+        assert n1 == n2 and v1 == v2 and np.array_equal(f1, f2)
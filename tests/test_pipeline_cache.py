@@ -0,0 +1,62 @@
+"""
+Tests of pipeline_cache.py: stages are skipped only while their inputs,
+parameters and outputs are unchanged, and files are written atomically.
+"""
+import os
+import sys
+import stat
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pipeline_cache import PipelineCache, save_atomic
+
+
+def test_run_skips_unchanged_stage(tmp_path):
+    source, output = tmp_path / 'input.txt', tmp_path / 'output.txt'
+    source.write_text('a')
+    calls = []
+
+    def build():
+        calls.append(1)
+        output.write_text(source.read_text())
+
+    cache = PipelineCache(str(tmp_path / 'cache'))
+    assert cache.run('stage', [str(source)], {'p': 1}, [str(output)], build)
+    assert not cache.run('stage', [str(source)], {'p': 1}, [str(output)], build)
+    assert cache.run('stage', [str(source)], {'p': 2}, [str(output)], build)
+    source.write_text('b')
+    assert cache.run('stage', [str(source)], {'p': 2}, [str(output)], build)
+    output.unlink()
+    assert cache.run('stage', [str(source)], {'p': 2}, [str(output)], build)
+    assert len(calls) == 4
+
+    # File hashes survive a new cache object once flushed.
+    cache.flush()
+    assert not PipelineCache(str(tmp_path / 'cache')).run(
+        'stage', [str(source)], {'p': 2}, [str(output)], build)
+
+
+def test_save_atomic(tmp_path):
+    path = str(tmp_path / 'out.txt')
+
+    def write(tmp_path, text):
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+
+    old = os.umask(0o022)
+    try:
+        save_atomic(path, write, 'first')
+    finally:
+        os.umask(old)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+    def fail(tmp_path):
+        write(tmp_path, 'partial')
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        save_atomic(path, fail)
+    with open(path) as f:
+        assert f.read() == 'first'
+    assert os.listdir(str(tmp_path)) == ['out.txt']
@@ -0,0 +1,67 @@
+"""
+Regression tests for spectral_fitting.py on spectra without any line.
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from spectrum_store import write_spectrum_store
+from spectral_fitting import fit_spectrum, fit_spectra
+from gaussian_fitter import fit_gaussians
+
+
+def noise_store(path, seed=0):
+    """Store holding one leaf whose on-source and background are pure noise."""
+    rng = np.random.RandomState(seed)
+    velocity = np.linspace(-100., 100., 200)
+    write_spectrum_store(str(path), {(6, 'HNCO'): (velocity,
+                                                   rng.normal(0., 0.1, velocity.size),
+                                                   rng.normal(0., 0.1, velocity.size))})
+    return {'survey': 'MALT90', 'molecule': 'HNCO', 'leaf': 6, 'kind': 'bgsub',
+            'store': str(path)}
+
+
+def test_failed_fit_of_noise_spectrum(tmp_path):
+    # A component far outside the band has zero gradient, so mpfit stops
+    # with gnorm=0 and gives no parameter errors.
+    job = noise_store(tmp_path)
+    job['priors'] = [(1., 1e4, 1.)]
+    row = fit_spectrum(job)
+    assert row['ncomp'] == 1
+    assert not row['converged']
+    for name in ('AMPLITUDE0_err', 'SHIFT0_err', 'WIDTH0_err', 'FWHM0_err'):
+        assert np.isnan(row[name])
+
+
+def test_batch_survives_noise_spectrum(tmp_path):
+    job = noise_store(tmp_path)
+    failing = dict(job, priors=[(1., 1e4, 1.)])
+    table = fit_spectra([failing, job], n_workers=2)
+    assert len(table) == 2
+    assert not table['converged'][0]
+
+
+def test_crashed_jobs_are_recorded(tmp_path):
+    job = noise_store(tmp_path)
+    bad_leaf = dict(job, leaf=99)
+    missing = dict(job, store=str(tmp_path / 'missing'))
+    for backend in ('pyspeckit', 'numpy'):
+        table = fit_spectra([job, bad_leaf, missing], backend=backend)
+        assert len(table) == 3
+        assert table['error'][0] == ''
+        assert table['error'][1].startswith('KeyError')
+        assert table['error'][2] != ''
+        assert not table['converged'][1] and not table['converged'][2]
+
+
+def test_spectrum_without_valid_channels_is_not_fitted():
+    velocity = np.linspace(-100., 100., 200)
+    spectra = np.vstack([np.exp(-0.5 * ((velocity - 10.) / 5.)**2),
+                         np.full(velocity.size, np.nan)])
+    result = fit_gaussians(velocity, spectra, [[1., 0., 4.], [1., 0., 4.]])
+    assert result['converged'][0] and not result['converged'][1]
+    assert np.isfinite(result['params'][0]).all()
+    assert np.isnan(result['params'][1]).all()
+    assert np.isnan(result['errors'][1]).all()
@@ -0,0 +1,49 @@
+"""
+Tests of spectrum_store.py: shared and per-molecule velocity axes, and the
+channel noise kept with the spectra.
+"""
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from spectrum_store import SpectrumStore, write_spectrum_store, channel_noise
+
+
+def offset_spectra(seed=0):
+    """Two molecules of one leaf, on grids offset by half a channel."""
+    rng = np.random.RandomState(seed)
+    v1 = np.linspace(-100., 100., 401)
+    v2 = v1[:-40] + 0.25
+    return {(1, 'HNCO'): (v1, rng.normal(0., 0.1, v1.size), rng.normal(0., 0.1, v1.size)),
+            (1, 'HCN'): (v2, rng.normal(0., 0.2, v2.size), rng.normal(0., 0.2, v2.size))}
+
+
+def test_offset_grids_keep_their_own_axis(tmp_path):
+    spectra = offset_spectra()
+    write_spectrum_store(str(tmp_path), spectra)
+    store = SpectrumStore(str(tmp_path))
+    assert store.resampled == []
+    for (leaf, mol), (velocity, on, bg) in spectra.items():
+        assert np.array_equal(store.molecule_velocity(mol), velocity)
+        assert np.allclose(store.spectrum(leaf, mol, 'on'), on)
+        assert np.allclose(store.spectrum(leaf, mol, 'bgsub'), on - bg)
+        assert np.isclose(store.spectrum_noise(leaf, mol, 'on'), channel_noise(on))
+        assert np.isclose(store.spectrum_noise(leaf, mol, 'bgsub'),
+                          np.hypot(channel_noise(on), channel_noise(bg)))
+
+
+def test_resampled_noise_is_measured_before_resampling(tmp_path):
+    spectra = offset_spectra()
+    velocity = spectra[(1, 'HNCO')][0]
+    write_spectrum_store(str(tmp_path), spectra, velocity=velocity)
+    store = SpectrumStore(str(tmp_path))
+    with open(os.path.join(str(tmp_path), 'index.json')) as f:
+        assert json.load(f)['resampled'] == ['HCN']
+    on = spectra[(1, 'HCN')][1]
+    assert np.array_equal(store.molecule_velocity('HCN'), velocity)
+    # Interpolation halfway between channels lowers the apparent noise.
+    assert channel_noise(store.spectrum(1, 'HCN', 'on')) < 0.8 * channel_noise(on)
+    assert np.isclose(store.spectrum_noise(1, 'HCN', 'on'), channel_noise(on))
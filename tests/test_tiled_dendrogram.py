@@ -0,0 +1,54 @@
+"""
+tiled_dendrogram.py against a single-pass astrodendro.Dendrogram.compute.
+"""
+import os
+import sys
+import numpy as np
+import astrodendro
+import pytest
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from leaf_index import LeafIndex, build_leaf_index
+from tiled_dendrogram import tiled_dendrogram, save_tiled_leaf_index
+
+params = {'min_value': 0.5, 'min_delta': 0.3, 'min_npix': 5}
+
+
+def blob_map(path, seed=1):
+    """Map of overlapping Gaussian blobs, written to `path`."""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:90, :70]
+    data = sum(a * np.exp(-((x - cx)**2 + (y - cy)**2) / (2 * s**2))
+               for a, cx, cy, s in rng.uniform([1, 0, 0, 2], [5, 70, 90, 6], (20, 4)))
+    fits.writeto(str(path), data, overwrite=True)
+    return data
+
+
+def test_tiled_matches_single_pass(tmp_path):
+    data = blob_map(tmp_path / 'map.fits')
+    tiled = tiled_dendrogram(str(tmp_path / 'map.fits'), str(tmp_path / 'index_map.npy'),
+                             tile=16, **params)
+    single = astrodendro.Dendrogram.compute(data, **params)
+    assert len(tiled) == len(single)
+    assert np.array_equal(np.asarray(tiled.index_map), single.index_map)
+    assert [s.idx for s in tiled.leaves] == [s.idx for s in single.leaves]
+
+    save_tiled_leaf_index(tiled, str(tmp_path / 'leaf_index.npz'), tile=16)
+    tiled_index = LeafIndex.load(str(tmp_path / 'leaf_index.npz'))
+    index = build_leaf_index(single, single.leaves)
+    assert np.array_equal(tiled_index.labels, index.labels)
+    assert np.array_equal(tiled_index.pixels, index.pixels)
+    assert np.array_equal(tiled_index.offsets, index.offsets)
+    assert tiled_index.views == index.views
+    assert sorted(os.listdir(str(tmp_path))) == ['index_map.npy',
+                                                 'index_map_structures.ecsv',
+                                                 'leaf_index.npz', 'map.fits']
+
+
+def test_region_larger_than_limit_fails(tmp_path):
+    blob_map(tmp_path / 'map.fits')
+    with pytest.raises(ValueError):
+        tiled_dendrogram(str(tmp_path / 'map.fits'), str(tmp_path / 'index_map.npy'),
+                         tile=16, max_region_npix=10, **params)
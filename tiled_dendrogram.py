@@ -0,0 +1,377 @@
+"""
+Tiled, out-of-core dendrogram of large column density mosaics (e.g. the
+full Hi-GAL Galactic plane), with the same result as a single
+`astrodendro.Dendrogram.compute` on the whole map.
+- astrodendro only ever connects neighbouring pixels above min_value, so every
+connected region of the map above min_value grows its own, independent
+trees. Those regions are found tile by tile from the memory-mapped map, and
+regions crossing tile edges are stitched together across the seams.
+- Each region is then computed on its own bounding box, in parallel, and the
+structures are renumbered in the order astrodendro uses (by their first
+pixel in the full map), so structure ids and the order of `leaves` match the
+single-pass dendrogram.
+- The index map is written to a .npy memmap, and the leaf index is built
+from it in bands of about one tile (`save_tiled_leaf_index`), with its label
+map and pixel lists in memmaps too.
+- Peak memory is therefore set by the tile size and by the bounding box of
+the largest region above min_value, which is computed in one piece. That
+box can be as large as the map when min_value is low; `max_region_npix`
+makes the run fail up front when a region's box exceeds it.
+"""
+import os
+import numpy as np
+import astrodendro
+from scipy import ndimage
+from astropy.io import fits
+from astropy.table import Table
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from leaf_index import LeafIndex, leaf_index_path
+# _____________________________________
+
+colfile = './../Data/higal_data/column_properunits_conv36_source_only.fits'
+index_map_file = './../Dendrogram_files/clouds_only_tiled_dendrogram.npy'
+min_value, min_delta, min_npix = 2e22, 5e22, 100
+tile = 2048
+# Largest region bounding box (pixels) computed in one piece; None for no limit
+max_region_npix = 16 * tile**2
+n_workers = os.cpu_count()
+
+TiledStructure = namedtuple('TiledStructure', ['idx', 'parent', 'is_leaf',
+                                               'npix', 'vmin', 'vmax',
+                                               'component'])
+
+# Per-process state, set by `_init_worker`.
+_tiles = {}
+
+
+def _init_worker(colfile, component_file=None):
+    _tiles['data'] = fits.getdata(colfile, memmap=True)
+    if component_file is not None:
+        _tiles['components'] = np.load(component_file, mmap_mode='r')
+
+
+def tile_slices(shape, tile):
+    """(y, x) slices of the tiles covering a map of `shape`."""
+    return [(slice(y, min(y+tile, shape[0])), slice(x, min(x+tile, shape[1])))
+            for y in range(0, shape[0], tile) for x in range(0, shape[1], tile)]
+
+
+def _label_tile(args):
+    view, min_value = args
+    labels, n = ndimage.label(np.asarray(_tiles['data'][view]) > min_value)
+    return labels.astype(np.int32), n
+
+
+def _union(pairs, nlabel):
+    """Smallest label connected to each label through `pairs` (2, npair)."""
+    root = np.arange(nlabel+1)
+    while pairs.size:
+        low = np.minimum(root[pairs[0]], root[pairs[1]])
+        before = root.copy()
+        np.minimum.at(root, pairs[0], low)
+        np.minimum.at(root, pairs[1], low)
+        root = root[root]
+        if np.array_equal(root, before):
+            break
+    return root
+
+
+def label_components(colfile, min_value, component_file, tile=2048, n_workers=1):
+    """
+    Label the connected regions of the map above `min_value` tile by tile
+    into the .npy memmap `component_file` (0 = below min_value), using the
+    same 4-connectivity as astrodendro.
+
+    Returns the (y0, y1, x0, x1) bounding box and pixel count of each region
+    (region n at row n-1).
+    """
+    shape = fits.getdata(colfile, memmap=True).shape
+    components = np.lib.format.open_memmap(component_file, mode='w+',
+                                           dtype=np.int32, shape=shape)
+    views = tile_slices(shape, tile)
+    args = [(view, min_value) for view in views]
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       initializer=_init_worker,
+                                       initargs=(colfile,))
+        results = executor.map(_label_tile, args)
+    else:
+        executor = None
+        _init_worker(colfile)
+        results = map(_label_tile, args)
+
+    boxes, npix = [np.zeros((1, 4), dtype=np.int64)], [np.zeros(1, dtype=np.int64)]
+    nlabel = 0
+    try:
+        for (ys, xs), (labels, n) in zip(views, results):
+            objects = ndimage.find_objects(labels)
+            boxes.append(np.array([[o[0].start+ys.start, o[0].stop+ys.start,
+                                    o[1].start+xs.start, o[1].stop+xs.start]
+                                   for o in objects], dtype=np.int64).reshape(-1, 4))
+            npix.append(np.bincount(labels.ravel(), minlength=n+1)[1:])
+            components[ys, xs] = np.where(labels > 0, labels + nlabel, 0)
+            nlabel += n
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    boxes, npix = np.concatenate(boxes), np.concatenate(npix)
+
+    # Stitch regions that touch across the tile seams.
+    pairs = []
+    for y in range(tile, shape[0], tile):
+        pairs.append(np.stack([components[y-1], components[y]]))
+    for x in range(tile, shape[1], tile):
+        pairs.append(np.stack([components[:, x-1], components[:, x]]))
+    pairs = np.concatenate(pairs, axis=1) if pairs else np.zeros((2, 0), dtype=int)
+    pairs = pairs[:, (pairs[0] > 0) & (pairs[1] > 0)]
+    root = _union(pairs, nlabel)
+
+    # Renumber the regions 1..n and merge their boxes and counts.
+    roots, lookup = np.unique(root, return_inverse=True)
+    ncomp = len(roots) - 1
+    bbox = np.zeros((ncomp+1, 4), dtype=np.int64)
+    bbox[:, [0, 2]] = np.iinfo(np.int64).max
+    np.minimum.at(bbox[:, 0], lookup, boxes[:, 0])
+    np.maximum.at(bbox[:, 1], lookup, boxes[:, 1])
+    np.minimum.at(bbox[:, 2], lookup, boxes[:, 2])
+    np.maximum.at(bbox[:, 3], lookup, boxes[:, 3])
+    counts = np.bincount(lookup, weights=npix, minlength=ncomp+1).astype(np.int64)
+    lookup = lookup.astype(np.int32)
+    for view in views:
+        components[view] = lookup[components[view]]
+    components.flush()
+    return bbox[1:], counts[1:]
+
+
+def _compute_components(args):
+    """
+    Dendrograms of a batch of regions, each on its own bounding box.
+    Returns per region its structures as (local idx, local parent, is_leaf,
+    npix, vmin, vmax, first pixel y, first pixel x) and its local index map.
+    """
+    batch, params = args
+    results = []
+    for number, (y0, y1, x0, x1) in batch:
+        view = (slice(y0, y1), slice(x0, x1))
+        inside = _tiles['components'][view] == number
+        data = np.where(inside, _tiles['data'][view], np.nan).astype(float)
+        dend = astrodendro.Dendrogram.compute(data, **params)
+        records = []
+        for s in dend.all_structures:
+            first = s.smallest_index
+            records.append((s.idx, s.parent.idx if s.parent is not None else -1,
+                            s.is_leaf, s.get_npix(), s.vmin, s.vmax,
+                            first[0]+y0, first[1]+x0))
+        results.append((number, view, records, dend.index_map))
+    return results
+
+
+class TiledDendrogram(object):
+    """
+    Index map and structure table of a dendrogram computed in tiles.
+    Structure ids, parents and the order of `leaves` are those of the
+    equivalent single-pass `astrodendro.Dendrogram`.
+    """
+
+    def __init__(self, index_map, structures, params=None):
+        self.index_map = index_map
+        self.structures = structures
+        self.params = params or {}
+
+    def __len__(self):
+        return len(self.structures)
+
+    @property
+    def all_structures(self):
+        return [TiledStructure(*row) for row in
+                self.structures.iterrows(*TiledStructure._fields)]
+
+    @property
+    def leaves(self):
+        """Leaves in idx order, as `Dendrogram.leaves`."""
+        return [s for s in self.all_structures if s.is_leaf]
+
+    @staticmethod
+    def structures_path(index_map_file):
+        return os.path.splitext(index_map_file)[0] + '_structures.ecsv'
+
+    @classmethod
+    def load(cls, index_map_file):
+        structures = Table.read(cls.structures_path(index_map_file),
+                                format='ascii.ecsv')
+        return cls(np.load(index_map_file, mmap_mode='r'), structures,
+                   params=dict(structures.meta))
+
+
+def tiled_dendrogram(colfile, index_map_file, min_value, min_delta=0, min_npix=0,
+                     tile=2048, n_workers=1, batch_npix=1000000,
+                     max_region_npix=None):
+    """
+    Dendrogram of the map in `colfile`, computed region by region.
+
+    The index map (-1 = no structure) is written to the .npy file
+    `index_map_file` and the structure table next to it (see
+    `TiledDendrogram.structures_path`). Regions are sent to the workers in
+    batches of about `batch_npix` pixels. Raises ValueError before any
+    region is computed if the bounding box of one is larger than
+    `max_region_npix` pixels.
+    """
+    params = {'min_value': min_value, 'min_delta': min_delta, 'min_npix': min_npix}
+    component_file = os.path.splitext(index_map_file)[0] + '_components.npy'
+    bbox, counts = label_components(colfile, min_value, component_file,
+                                    tile=tile, n_workers=n_workers)
+    area = (bbox[:, 1] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 2])
+    if max_region_npix is not None and area.size and area.max() > max_region_npix:
+        os.remove(component_file)
+        raise ValueError("A region above min_value={0} has a {1}-pixel bounding "
+                         "box, more than max_region_npix={2}; raise min_value "
+                         "or max_region_npix".format(min_value, int(area.max()),
+                                                     max_region_npix))
+
+    batches, batch, size = [], [], 0
+    for number, box in enumerate(bbox, start=1):
+        batch.append((number, tuple(int(b) for b in box)))
+        size += counts[number-1]
+        if size >= batch_npix:
+            batches.append((batch, params))
+            batch, size = [], 0
+    if batch:
+        batches.append((batch, params))
+
+    shape = fits.getdata(colfile, memmap=True).shape
+    index_map = np.lib.format.open_memmap(index_map_file, mode='w+',
+                                          dtype=np.int32, shape=shape)
+    for view in tile_slices(shape, tile):
+        index_map[view] = -1
+
+    if n_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers,
+                                       initializer=_init_worker,
+                                       initargs=(colfile, component_file))
+        results = executor.map(_compute_components, batches)
+    else:
+        executor = None
+        _init_worker(colfile, component_file)
+        results = map(_compute_components, batches)
+
+    # Write provisional ids (offset + local idx) while the regions come in,
+    # then renumber everything once all structures are known.
+    records, offset = [], 0
+    try:
+        for batch_results in results:
+            for number, view, local_records, local_map in batch_results:
+                for rec in local_records:
+                    records.append((offset + rec[0],
+                                    offset + rec[1] if rec[1] >= 0 else -1,
+                                    number) + tuple(rec[2:]))
+                index_map[view] = np.where(local_map >= 0, local_map + offset,
+                                           index_map[view])
+                offset += len(local_records)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        _tiles.clear()
+        os.remove(component_file)
+
+    names = ['provisional', 'parent', 'component', 'is_leaf', 'npix', 'vmin',
+             'vmax', 'first_y', 'first_x']
+    rec = Table(rows=records, names=names,
+                dtype=[int, int, int, bool, int, float, float, int, int])
+    order = np.lexsort((rec['first_x'], rec['first_y']))
+    lookup = np.full(offset + 1, -1, dtype=np.int32)
+    lookup[np.asarray(rec['provisional'])[order] + 1] = np.arange(len(order))
+    for view in tile_slices(shape, tile):
+        index_map[view] = lookup[index_map[view] + 1]
+    index_map.flush()
+
+    rec = rec[order]
+    structures = Table()
+    structures['idx'] = np.arange(len(rec))
+    structures['parent'] = lookup[np.asarray(rec['parent'], dtype=int) + 1]
+    for name in ['is_leaf', 'npix', 'vmin', 'vmax', 'component']:
+        structures[name] = rec[name]
+    structures.meta.update(params)
+    structures.write(TiledDendrogram.structures_path(index_map_file),
+                     format='ascii.ecsv', overwrite=True)
+    return TiledDendrogram(np.load(index_map_file, mmap_mode='r'), structures,
+                           params=params)
+
+
+def band_slices(shape, npix):
+    """Slices of consecutive rows of about `npix` pixels covering `shape`."""
+    rows = max(1, npix // shape[1])
+    return [slice(y, min(y+rows, shape[0])) for y in range(0, shape[0], rows)]
+
+
+def save_tiled_leaf_index(dend, path, header=None, tile=2048):
+    """
+    Save the leaf index of a `TiledDendrogram` (leaves numbered from 1 in
+    idx order) to `path`, as `LeafIndex.save` does, without holding any
+    full-map array in memory: the label map is written band by band to a
+    memmap, and the pixel lists are filled in with a counting sort over the
+    same bands. Both memmaps are removed once the index is saved.
+    """
+    shape = dend.index_map.shape
+    leaves = dend.leaves
+    nlab = len(leaves) + 1
+    lookup = np.zeros(len(dend) + 1, dtype=np.int32)
+    struct_idx = np.array([leaf.idx for leaf in leaves], dtype=int)
+    lookup[struct_idx + 1] = np.arange(1, nlab)
+    bands = band_slices(shape, tile * tile)
+
+    root = os.path.splitext(path)[0]
+    labels_file, pixels_file = root + '_labels.npy', root + '_pixels.npy'
+    try:
+        # Label map, pixel counts and bounding boxes.
+        labels = np.lib.format.open_memmap(labels_file, mode='w+', dtype=np.int32,
+                                           shape=shape)
+        counts = np.zeros(nlab, dtype=np.int64)
+        box = np.zeros((nlab, 4), dtype=np.int64)
+        box[:, [0, 2]] = np.iinfo(np.int64).max
+        for band in bands:
+            band_labels = lookup[np.asarray(dend.index_map[band]) + 1]
+            labels[band] = band_labels
+            counts += np.bincount(band_labels.ravel(), minlength=nlab)
+            for n, o in enumerate(ndimage.find_objects(band_labels, max_label=nlab-1),
+                                  start=1):
+                if o is not None:
+                    box[n] = [min(box[n, 0], o[0].start + band.start),
+                              max(box[n, 1], o[0].stop + band.start),
+                              min(box[n, 2], o[1].start), max(box[n, 3], o[1].stop)]
+        views = dict((n, (slice(box[n, 0], box[n, 1]), slice(box[n, 2], box[n, 3])))
+                     for n in range(1, nlab) if counts[n])
+
+        # Pixels of each leaf in raster order, as a stable argsort of the
+        # label map would give them.
+        offsets = np.concatenate([[0], np.cumsum(counts[1:])])
+        pixels = np.lib.format.open_memmap(pixels_file, mode='w+', dtype=np.int64,
+                                           shape=(int(offsets[-1]),))
+        position = offsets[:-1].copy()
+        for band in bands:
+            flat = np.asarray(labels[band]).ravel()
+            order = np.argsort(flat, kind='stable')
+            order = order[flat[order] > 0]
+            sorted_labels = flat[order]
+            rank = (np.arange(order.size) -
+                    np.searchsorted(sorted_labels, sorted_labels, side='left'))
+            pixels[position[sorted_labels - 1] + rank] = band.start * shape[1] + order
+            position += np.bincount(sorted_labels, minlength=nlab)[1:]
+
+        index = LeafIndex(labels, np.arange(1, nlab), struct_idx, header=header,
+                          pixels=pixels, offsets=offsets, views=views)
+        index.save(path)
+        del index, labels, pixels
+    finally:
+        for filename in (labels_file, pixels_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+    return path
+
+
+if __name__ == "__main__":
+    dend = tiled_dendrogram(colfile, index_map_file, min_value=min_value,
+                            min_delta=min_delta, min_npix=min_npix, tile=tile,
+                            n_workers=n_workers, max_region_npix=max_region_npix)
+    save_tiled_leaf_index(dend, leaf_index_path(index_map_file),
+                          header=fits.getheader(colfile), tile=tile)